@@ -0,0 +1,253 @@
+import argparse
+import io
+import json
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+from contextlib import redirect_stdout
+from datetime import datetime
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "codeBase"))
+
+import claimsProcessor  # noqa: E402
+from runReport import RunReport  # noqa: E402
+from claimsGenerator import generate_database, parse_size  # noqa: E402
+
+def legacy_fetch_claims_data(conn):
+    """Original N+1 loader: one service_lines query per claim"""
+    cursor = conn.cursor()
+    cursor.execute(claimsProcessor.CLAIMS_QUERY)
+    claims = cursor.fetchall()
+    for i, claim in enumerate(claims):
+        cursor.execute('SELECT * FROM service_lines WHERE claim_id = ?', (claim['claim_id'],))
+        service_lines = cursor.fetchall()
+        claims[i] = dict(claim)
+        claims[i]['service_lines'] = [dict(line) for line in service_lines]
+    return claims
+
+def legacy_format_date(date_str, format_in='%Y-%m-%d', format_out='%Y%m%d'):
+    """Original format_date: strptime and strftime on every call"""
+    if not date_str:
+        return ''
+    try:
+        return datetime.strptime(date_str, format_in).strftime(format_out)
+    except ValueError:
+        return date_str
+
+def timed(func, *args, repeat=3):
+    """Best wall time of repeat runs, and the last result"""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+def bench_loaders(db_path, repeat=3):
+    conn = sqlite3.connect(db_path)
+    conn.row_factory = sqlite3.Row
+
+    legacy_time, legacy_claims = timed(legacy_fetch_claims_data, conn, repeat=repeat)
+    new_time, new_claims = timed(claimsProcessor.fetch_claims_data, conn, repeat=repeat)
+    conn.close()
+
+    key = lambda claim: claim['claim_id']  # noqa: E731
+    if sorted(legacy_claims, key=key) != new_claims:
+        raise AssertionError("Loaders returned different claims")
+
+    print(f"{'loader':<24}{'seconds':>10}{'claims/s':>14}")
+    for name, elapsed in (('legacy N+1', legacy_time), ('set-based', new_time)):
+        print(f"{name:<24}{elapsed:>10.3f}{len(new_claims) / elapsed:>14,.0f}")
+    print(f"Speedup: {legacy_time / new_time:.1f}x over {len(new_claims)} claims")
+
+def bench_validation(db_path, repeat=3):
+    try:
+        import pandas  # noqa: F401
+    except ImportError:
+        print("pandas not installed, skipping columnar validation benchmark")
+        return
+
+    conn = sqlite3.connect(db_path)
+    conn.row_factory = sqlite3.Row
+
+    def row_by_row():
+        return claimsProcessor.validate_claims(claimsProcessor.fetch_claims_data(conn))
+
+    row_time, (valid_claims, row_results) = timed(row_by_row, repeat=repeat)
+    columnar_time, (total, invalid_ids, columnar_results) = timed(
+        claimsProcessor.validate_claims_columnar, conn, repeat=repeat
+    )
+    conn.close()
+
+    as_tuples = lambda results: [(e.claim_id, e.level, e.message, e.field) for e in results]  # noqa: E731
+    if as_tuples(row_results) != as_tuples(columnar_results) or len(valid_claims) != total - len(invalid_ids):
+        raise AssertionError("Validation paths returned different results")
+
+    print(f"{'validation (incl. load)':<24}{'seconds':>10}{'claims/s':>14}")
+    for name, elapsed in (('row by row', row_time), ('columnar', columnar_time)):
+        print(f"{name:<24}{elapsed:>10.3f}{total / elapsed:>14,.0f}")
+    print(f"Speedup: {row_time / columnar_time:.1f}x over {total} claims")
+
+def bench_format_date(db_path, repeat=3):
+    """Micro-benchmark format_date on every date the 837I writer formats"""
+    conn = sqlite3.connect(db_path)
+    dates = [
+        value
+        for row in conn.execute(
+            'SELECT p.dob, c.admission_date, c.discharge_date, c.statement_from_date, c.statement_to_date '
+            'FROM claims c JOIN patients p ON c.patient_id = p.patient_id'
+        )
+        for value in row
+    ]
+    dates.extend(row[0] for row in conn.execute('SELECT service_date FROM service_lines'))
+    conn.close()
+
+    def run(func):
+        return [func(value) for value in dates]
+
+    claimsProcessor._format_iso_date.cache_clear()
+    legacy_time, legacy_dates = timed(run, legacy_format_date, repeat=repeat)
+    new_time, new_dates = timed(run, claimsProcessor.format_date, repeat=repeat)
+    if legacy_dates != new_dates:
+        raise AssertionError("format_date returned different dates")
+
+    print(f"{'format_date':<24}{'seconds':>10}{'dates/s':>14}")
+    for name, elapsed in (('strptime', legacy_time), ('sliced + cached', new_time)):
+        print(f"{name:<24}{elapsed:>10.3f}{len(dates) / elapsed:>14,.0f}")
+    print(f"Speedup: {legacy_time / new_time:.1f}x over {len(dates)} dates "
+          f"({len(set(dates))} distinct)")
+
+def run_pipeline(db_path, workdir, workers=None):
+    """Run every claimsProcessor stage once and return the stage records
+
+    The database is opened with connect_to_db, so the connect stage
+    includes creating any missing loader indexes. 837I files, the control
+    number database and the validation log go to workdir. Stages are timed
+    with RunReport, so their records match the processor's run report.
+    """
+    claimsProcessor.OUTPUT_DIR = os.path.join(workdir, 'output_837i_files')
+    claimsProcessor.CONTROL_DB_PATH = os.path.join(workdir, 'control_numbers.db')
+    report = RunReport()
+
+    with report.stage('connect'):
+        with redirect_stdout(io.StringIO()):
+            conn = claimsProcessor.connect_to_db(db_path)
+
+    with report.stage('fetch') as stage:
+        claims = claimsProcessor.fetch_claims_data(conn)
+        stage['items'] = len(claims)
+
+    with report.stage('validate') as stage:
+        valid_claims, validation_results = claimsProcessor.validate_claims(claims)
+        stage['items'] = len(claims)
+
+    with report.stage('validate_subscribers') as stage:
+        validation_results.extend(claimsProcessor.validate_subscriber_info(valid_claims))
+        stage['items'] = len(valid_claims)
+
+    with report.stage('generate_837i') as stage:
+        with redirect_stdout(io.StringIO()):
+            claimsProcessor.generate_837i_file(valid_claims, workers=workers)
+        stage['items'] = len(valid_claims)
+
+    with report.stage('write_log') as stage:
+        log = claimsProcessor.open_validation_log()
+        log.extend(validation_results)
+        log.close({'total': len(claims), 'valid': len(valid_claims)})
+        stage['items'] = len(validation_results)
+
+    conn.close()
+    return report.stages
+
+def print_stages(stages, baseline=None, tolerance=0.1):
+    """Print the stage table, with change against baseline stages if given
+
+    Returns the names of stages more than tolerance slower than baseline.
+    """
+    regressions = []
+    header = f"{'stage':<24}{'seconds':>10}{'items/s':>14}{'peak RSS MB':>14}"
+    print(header + (f"{'baseline s':>12}{'change':>9}" if baseline else ""))
+    for name, record in stages.items():
+        rss = f"{record['peak_rss_mb']:.0f}" if record['peak_rss_mb'] is not None else '-'
+        line = f"{name:<24}{record['seconds']:>10.3f}{record['per_second']:>14,.0f}{rss:>14}"
+        if baseline and name in baseline:
+            base_seconds = baseline[name]['seconds']
+            change = (record['seconds'] - base_seconds) / base_seconds if base_seconds else 0.0
+            line += f"{base_seconds:>12.3f}{change:>+9.1%}"
+            # Ignore noise on stages too short to time reliably
+            if change > tolerance and record['seconds'] - base_seconds > 0.05:
+                regressions.append(name)
+                line += "  REGRESSION"
+        print(line)
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the claims processor on a generated database')
+    parser.add_argument('--claims', type=parse_size, default=20000, help='claims to generate, e.g. 10k or 1M')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=3, help='runs per micro-benchmark')
+    parser.add_argument('--db', help='use an existing database instead of generating one')
+    parser.add_argument('--workers', type=int, default=None, help='worker processes for 837I generation')
+    parser.add_argument('--micro', action='store_true',
+                        help='also compare loaders, validation paths and format_date against the originals')
+    parser.add_argument('--save-baseline', metavar='PATH', help='save the stage results as a JSON baseline')
+    parser.add_argument('--baseline', metavar='PATH', help='compare the stage results against a saved baseline')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='slowdown against the baseline that counts as a regression (default 10%%)')
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = args.db
+        generate_seconds = None
+        if db_path is None:
+            db_path = os.path.join(tmp, 'institutional_claims.db')
+            start = time.perf_counter()
+            generate_database(db_path, args.claims, seed=args.seed)
+            generate_seconds = time.perf_counter() - start
+
+        conn = sqlite3.connect(db_path)
+        claim_count, line_count = (
+            conn.execute('SELECT COUNT(*) FROM claims').fetchone()[0],
+            conn.execute('SELECT COUNT(*) FROM service_lines').fetchone()[0],
+        )
+        conn.close()
+        print(f"Database: {claim_count:,} claims, {line_count:,} service lines"
+              + (f" (generated in {generate_seconds:.1f}s)" if generate_seconds is not None else ""))
+        print()
+
+        stages = run_pipeline(db_path, tmp, workers=args.workers)
+        baseline = None
+        if args.baseline:
+            with open(args.baseline) as f:
+                baseline = json.load(f)['stages']
+        regressions = print_stages(stages, baseline, args.tolerance)
+
+        if args.save_baseline:
+            with open(args.save_baseline, 'w') as f:
+                json.dump({
+                    'claims': claim_count,
+                    'service_lines': line_count,
+                    'created': datetime.now().isoformat(),
+                    'stages': stages,
+                }, f, indent=2)
+            print(f"Baseline saved to {args.save_baseline}")
+
+        if args.micro:
+            print()
+            bench_loaders(db_path, repeat=args.repeat)
+            print()
+            bench_validation(db_path, repeat=args.repeat)
+            print()
+            bench_format_date(db_path, repeat=args.repeat)
+
+    if regressions:
+        print(f"Regressed stages: {', '.join(regressions)}")
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,212 @@
+import argparse
+import os
+import random
+import sqlite3
+import sys
+from datetime import date, timedelta
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS patients (
+    patient_id INTEGER PRIMARY KEY,
+    first_name TEXT, last_name TEXT, gender TEXT, dob TEXT,
+    address_line_1 TEXT, city TEXT, state TEXT, zip_code TEXT
+);
+CREATE TABLE IF NOT EXISTS providers (
+    provider_id INTEGER PRIMARY KEY,
+    npi TEXT, organization_name TEXT,
+    provider_first_name TEXT, provider_last_name TEXT, taxonomy_code TEXT,
+    address_line_1 TEXT, city TEXT, state TEXT, zip_code TEXT,
+    legacy_provider_id TEXT
+);
+CREATE TABLE IF NOT EXISTS payers (
+    payer_id INTEGER PRIMARY KEY,
+    payer_name TEXT, payer_id_code TEXT
+);
+CREATE TABLE IF NOT EXISTS subscribers (
+    subscriber_id INTEGER PRIMARY KEY,
+    insured_first_name TEXT, insured_last_name TEXT, insured_id TEXT,
+    relationship_code TEXT, policy_number TEXT, group_number TEXT
+);
+CREATE TABLE IF NOT EXISTS claims (
+    claim_id INTEGER PRIMARY KEY,
+    patient_id INTEGER, provider_id INTEGER, payer_id INTEGER, subscriber_id INTEGER,
+    claim_control_number TEXT, patient_control_number TEXT, claim_amount REAL,
+    transaction_type_code TEXT, claim_filing_indicator_code TEXT,
+    entity_type_qualifier TEXT, provider_accept_assignment_code TEXT,
+    benefits_assignment_cert_indicator TEXT, release_info_code TEXT,
+    place_of_service_code TEXT, claim_frequency_type_code TEXT, patient_status_code TEXT,
+    admission_date TEXT, discharge_date TEXT,
+    statement_from_date TEXT, statement_to_date TEXT,
+    principal_diagnosis_code TEXT, secondary_diagnosis_codes TEXT,
+    referring_provider_npi TEXT, attending_provider_npi TEXT
+);
+CREATE TABLE IF NOT EXISTS service_lines (
+    service_line_id INTEGER PRIMARY KEY,
+    claim_id INTEGER, line_number INTEGER,
+    revenue_code TEXT, procedure_code_qualifier TEXT, procedure_code TEXT,
+    charge_amount REAL, units INTEGER, service_date TEXT
+);
+'''
+
+# Created after the bulk load, which is much faster than maintaining them row by row
+INDEXES = '''
+CREATE INDEX IF NOT EXISTS idx_service_lines_claim_id ON service_lines (claim_id);
+'''
+
+FIRST_NAMES = ['JOHN', 'MARY', 'JAMES', 'LINDA', 'ROBERT', 'SUSAN', 'DAVID', 'KAREN']
+LAST_NAMES = ['SMITH', 'JOHNSON', 'WILLIAMS', 'BROWN', 'JONES', 'MILLER', 'DAVIS', 'WILSON']
+CITIES = [('LOUISVILLE', '40202'), ('LEXINGTON', '40507'), ('FRANKFORT', '40601'), ('BOWLING GREEN', '42101')]
+DIAGNOSIS_CODES = ['I10', 'E119', 'J449', 'N390', 'R079', 'M545', 'F329', 'K219']
+REVENUE_CODES = ['0120', '0250', '0300', '0450', '0636', '0730']
+PROCEDURE_CODES = ['99213', '99214', '85025', '80053', '93000', '71046']
+
+def _random_date(rng, start, span_days):
+    return (start + timedelta(days=rng.randrange(span_days))).isoformat()
+
+def parse_size(size):
+    """Parse a claim count such as 10000, 10k, 2.5M or 10M"""
+    size = str(size).strip().lower().replace('_', '')
+    multiplier = {'k': 1000, 'm': 1000000}.get(size[-1:], 1)
+    if multiplier != 1:
+        size = size[:-1]
+    return int(float(size) * multiplier)
+
+def _line_count(rng, max_lines, skew):
+    """Service lines for one claim, heavy tailed
+
+    Most institutional claims carry one to three lines while a few inpatient
+    stays carry dozens, so counts follow a Pareto distribution with shape
+    skew (lower is heavier), capped at max_lines.
+    """
+    return min(max_lines, int(rng.paretovariate(skew)))
+
+def _skewed_id(rng, count):
+    """Pick an id in 1..count, favouring low ids the way a few large facilities bill most claims"""
+    return int(count * rng.random() ** 3) + 1
+
+def _address(rng, street):
+    city, zip_code = rng.choice(CITIES)
+    return f"{rng.randint(1, 9999)} {street}", city, 'KY', zip_code
+
+def generate_database(path, num_claims, seed=0, invalid_rate=0.05, max_lines=100, skew=1.3,
+                      chunk_size=100000, progress=None, overwrite=False):
+    """Build a synthetic institutional_claims.db with num_claims claims
+
+    The same seed always produces the same database. Rows are inserted in
+    chunks of chunk_size inside one transaction with journaling off, so
+    tens of millions of rows can be generated; progress, if given, is
+    called with the number of claims written so far after each chunk. An
+    existing database at path is only replaced when overwrite is set.
+    """
+    rng = random.Random(seed)
+    num_patients = max(1, num_claims // 4)
+    num_providers = max(1, num_claims // 100)
+    num_payers = 3
+
+    if os.path.exists(path):
+        if not overwrite:
+            raise FileExistsError(path)
+        os.remove(path)
+    conn = sqlite3.connect(path)
+    conn.execute('PRAGMA journal_mode = OFF')
+    conn.execute('PRAGMA synchronous = OFF')
+    conn.executescript(SCHEMA)
+
+    conn.executemany(
+        'INSERT INTO patients VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+        (
+            (i, rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES), rng.choice('MF'),
+             _random_date(rng, date(1940, 1, 1), 365 * 80),
+             *_address(rng, 'MAIN ST'))
+            for i in range(1, num_patients + 1)
+        )
+    )
+    conn.executemany(
+        'INSERT INTO providers VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+        (
+            (i, str(1000000000 + i), f"KY HOSPITAL {i}" if i % 3 else None,
+             rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES), '282N00000X',
+             *_address(rng, 'HOSPITAL DR'),
+             f"LP{i:06d}")
+            for i in range(1, num_providers + 1)
+        )
+    )
+    conn.executemany(
+        'INSERT INTO payers VALUES (?, ?, ?)',
+        ((i, f"PAYER {i}", f"PAYER{i:03d}") for i in range(1, num_payers + 1))
+    )
+    conn.executemany(
+        'INSERT INTO subscribers VALUES (?, ?, ?, ?, ?, ?, ?)',
+        (
+            (i, rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES), f"MI{i:09d}",
+             rng.choice(['18', '18', '18', '01', '19']), f"POL{i:08d}",
+             f"GRP{i % 50:04d}" if i % 4 else None)
+            for i in range(1, num_patients + 1)
+        )
+    )
+
+    def claim_row(claim_id):
+        patient_id = rng.randint(1, num_patients)
+        admission = date(2024, 1, 1) + timedelta(days=rng.randrange(365))
+        discharge = admission + timedelta(days=rng.randrange(10))
+        invalid = rng.random() < invalid_rate
+        return (
+            claim_id, patient_id, _skewed_id(rng, num_providers), rng.randint(1, num_payers), patient_id,
+            f"CCN{claim_id:09d}", f"PCN{claim_id:09d}", round(rng.uniform(50, 50000), 2),
+            rng.choice(['CH', 'RP']) if not invalid else '31',
+            'MC' if not invalid or rng.random() < 0.5 else 'CI',
+            '1', 'A', 'Y', 'Y',
+            rng.choice(['11', '13', '83']), rng.choice(['1', '1', '1', '7', '8']), rng.choice(['01', '02', '30']),
+            admission.isoformat(), discharge.isoformat(), admission.isoformat(), discharge.isoformat(),
+            rng.choice(DIAGNOSIS_CODES),
+            ','.join(rng.sample(DIAGNOSIS_CODES, rng.randint(0, 4))) or None,
+            str(1500000000 + rng.randint(1, 9999)) if rng.random() < 0.3 else None,
+            str(1600000000 + rng.randint(1, 9999)) if rng.random() < 0.7 else None,
+        )
+
+    def line_rows(claim_id):
+        service_date = date(2024, 1, 1) + timedelta(days=rng.randrange(365))
+        for line_number in range(1, _line_count(rng, max_lines, skew) + 1):
+            yield (
+                claim_id, line_number, rng.choice(REVENUE_CODES),
+                'HC' if rng.random() > 0.02 else 'ER', rng.choice(PROCEDURE_CODES),
+                round(rng.uniform(10, 5000), 2), rng.randint(1, 5), service_date.isoformat(),
+            )
+
+    for chunk_start in range(1, num_claims + 1, chunk_size):
+        claim_ids = range(chunk_start, min(chunk_start + chunk_size, num_claims + 1))
+        conn.executemany(f"INSERT INTO claims VALUES ({', '.join('?' * 25)})", [claim_row(i) for i in claim_ids])
+        conn.executemany(
+            'INSERT INTO service_lines (claim_id, line_number, revenue_code, procedure_code_qualifier, '
+            'procedure_code, charge_amount, units, service_date) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+            [row for i in claim_ids for row in line_rows(i)]
+        )
+        if progress:
+            progress(claim_ids[-1])
+
+    conn.executescript(INDEXES)
+    conn.commit()
+    conn.close()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Generate a synthetic institutional claims database')
+    parser.add_argument('path', nargs='?', default='institutional_claims.db')
+    parser.add_argument('--claims', type=parse_size, default=10000, help='number of claims, e.g. 10k or 10M')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--invalid-rate', type=float, default=0.05, help='share of claims that fail validation')
+    parser.add_argument('--max-lines', type=int, default=100, help='most service lines on one claim')
+    parser.add_argument('--skew', type=float, default=1.3,
+                        help='Pareto shape of service lines per claim, lower is heavier tailed')
+    parser.add_argument('--force', action='store_true', help='replace an existing database at path')
+    args = parser.parse_args(argv)
+
+    def progress(done):
+        print(f"\r{done:,} / {args.claims:,} claims", end='', flush=True)
+
+    generate_database(args.path, args.claims, seed=args.seed, invalid_rate=args.invalid_rate,
+                      max_lines=args.max_lines, skew=args.skew, progress=progress, overwrite=args.force)
+    print(f"\nGenerated {args.claims} claims in {args.path}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,139 @@
+import hashlib
+import sqlite3
+from datetime import datetime
+
+from validationRules import ErrorLevel, ValidationError
+
+# CLM05-3 claim frequency codes that resubmit a claim already sent to the payer
+RESUBMISSION_FREQUENCY_CODES = frozenset({'7', '8'})  # replacement, void
+
+def content_hash(claim):
+    """Hash everything the 837I is built from: the claim's fields and its service lines
+
+    Claims are dicts built from the loader queries, so their field order is
+    fixed and repr() of the values is stable from run to run.
+    """
+    lines = claim.get('service_lines', ())
+    content = repr((
+        tuple(value for key, value in claim.items() if key != 'service_lines'),
+        tuple(tuple(line.values()) for line in lines),
+    ))
+    return hashlib.blake2b(content.encode(), digest_size=16).hexdigest()
+
+class ClaimChangeTracker:
+    """Remember which claims were submitted so later runs only process changes
+
+    Each submitted claim's content hash and frequency code are kept in the
+    claim_state table, along with a watermark holding the highest claim_id
+    read so far. changes() passes on only claims that are new or whose
+    content differs from what was submitted; claims that failed validation
+    are never recorded, so they are checked again on every run.
+
+    A submitted claim that changes must come back as a replacement or void
+    (frequency code 7 or 8). Sending it again as an original would duplicate
+    it at the payer, so it is held back with an ERROR instead.
+
+    Nothing is stored until commit(), which should be called once the 837I
+    files have been written.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path, timeout=30)
+        self.conn.executescript('''
+        CREATE TABLE IF NOT EXISTS claim_state (
+            claim_id INTEGER PRIMARY KEY,
+            content_hash TEXT NOT NULL,
+            frequency_code TEXT,
+            submitted_at TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS claim_watermark (
+            name TEXT PRIMARY KEY,
+            value INTEGER NOT NULL
+        );
+        ''')
+        row = self.conn.execute("SELECT value FROM claim_watermark WHERE name = 'claim_id'").fetchone()
+        self.watermark = row[0] if row else None
+        self.submitted = {}
+        self.pending = {}
+        self.written = []
+        self.max_claim_id = self.watermark
+
+    def load(self):
+        """Read the stored hashes of submitted claims into memory"""
+        self.submitted = {
+            claim_id: (digest, frequency_code)
+            for claim_id, digest, frequency_code in self.conn.execute(
+                'SELECT claim_id, content_hash, frequency_code FROM claim_state'
+            )
+        }
+
+    def changes(self, claims, validation_results):
+        """Yield the claims that are new or changed since they were submitted
+
+        Changed claims that would be resubmitted as originals are dropped
+        with an ERROR added to validation_results.
+        """
+        if not self.submitted:
+            self.load()
+        submitted = self.submitted
+        for claim in claims:
+            claim_id = claim['claim_id']
+            if self.max_claim_id is None or claim_id > self.max_claim_id:
+                self.max_claim_id = claim_id
+
+            digest = content_hash(claim)
+            previous = submitted.get(claim_id)
+            if previous is not None:
+                if previous[0] == digest:
+                    continue
+                if claim.get('claim_frequency_type_code') not in RESUBMISSION_FREQUENCY_CODES:
+                    validation_results.append(ValidationError(
+                        claim_id, ErrorLevel.ERROR,
+                        "Claim changed after it was submitted; resubmit it with frequency code 7 (replacement) "
+                        "or 8 (void)",
+                        'CLM05-3'
+                    ))
+                    continue
+
+            self.pending[claim_id] = (digest, claim.get('claim_frequency_type_code'))
+            yield claim
+
+    def mark(self, claim):
+        """Note a claim as written to an 837I file"""
+        self.written.append(claim['claim_id'])
+
+    def mark_submitted(self, claims):
+        """Pass claims through, noting each one as written to an 837I file"""
+        for claim in claims:
+            self.mark(claim)
+            yield claim
+
+    def commit(self):
+        """Store the claims written this run and advance the watermark"""
+        submitted_at = datetime.now().isoformat()
+        written = self.written
+        with self.conn:
+            self.conn.executemany(
+                'INSERT OR REPLACE INTO claim_state (claim_id, content_hash, frequency_code, submitted_at) '
+                'VALUES (?, ?, ?, ?)',
+                ((claim_id, *self.pending[claim_id], submitted_at) for claim_id in written)
+            )
+            if self.max_claim_id is not None:
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO claim_watermark (name, value) VALUES ('claim_id', ?)",
+                    (self.max_claim_id,)
+                )
+        for claim_id in written:
+            self.submitted[claim_id] = self.pending.pop(claim_id)
+        self.written = []
+        self.watermark = self.max_claim_id
+        return len(written)
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
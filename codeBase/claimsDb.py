@@ -0,0 +1,91 @@
+# Read-optimized connection settings. WAL lets the processor read while
+# claims are being loaded, mmap_size maps up to 256 MB of the file instead
+# of copying pages through read(), and the negative cache_size is in KiB.
+PRAGMAS = (
+    ('journal_mode', 'WAL'),
+    ('synchronous', 'NORMAL'),
+    ('mmap_size', 256 * 1024 * 1024),
+    ('cache_size', -64 * 1024),
+    ('temp_store', 'MEMORY'),
+)
+
+# Indexes the claim loader relies on, as (name, table, columns). The join
+# keys are usually INTEGER PRIMARY KEYs already, in which case no index is
+# created. service_lines is read ordered by (claim_id, line_number), so an
+# index on both lets SQLite walk it in order instead of sorting the table.
+REQUIRED_INDEXES = (
+    ('idx_claims_claim_id', 'claims', ('claim_id',)),
+    ('idx_patients_patient_id', 'patients', ('patient_id',)),
+    ('idx_providers_provider_id', 'providers', ('provider_id',)),
+    ('idx_payers_payer_id', 'payers', ('payer_id',)),
+    ('idx_subscribers_subscriber_id', 'subscribers', ('subscriber_id',)),
+    ('idx_service_lines_claim_line', 'service_lines', ('claim_id', 'line_number')),
+)
+
+def apply_pragmas(conn, pragmas=PRAGMAS):
+    """Apply connection pragmas and return the values SQLite reports back
+
+    journal_mode cannot be changed on a read-only or in-memory database;
+    SQLite keeps the old mode and reports it, so the result shows what was
+    actually applied.
+    """
+    applied = {}
+    for name, value in pragmas:
+        conn.execute(f"PRAGMA {name} = {value}")
+        row = conn.execute(f"PRAGMA {name}").fetchone()
+        applied[name] = row[0] if row else None
+    return applied
+
+def _is_indexed(conn, table, columns):
+    """Check whether columns are a rowid alias or the leading columns of an index"""
+    if len(columns) == 1:
+        for _, name, col_type, _, _, pk in conn.execute(f"PRAGMA table_info({table})"):
+            if name == columns[0] and pk == 1 and col_type.upper() == 'INTEGER':
+                return True
+
+    for index in conn.execute(f"PRAGMA index_list({table})"):
+        index_columns = tuple(row[2] for row in conn.execute(f"PRAGMA index_info({index[1]})"))
+        if index_columns[:len(columns)] == tuple(columns):
+            return True
+    return False
+
+def ensure_indexes(conn, indexes=REQUIRED_INDEXES):
+    """Create any of the loader's indexes that are missing
+
+    Returns the names of the indexes created. Tables that do not exist are
+    skipped. Raises sqlite3.OperationalError if an index is missing and the
+    database is read-only.
+    """
+    tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    created = []
+    for name, table, columns in indexes:
+        if table not in tables or _is_indexed(conn, table, columns):
+            continue
+        conn.execute(f"CREATE INDEX IF NOT EXISTS {name} ON {table} ({', '.join(columns)})")
+        created.append(name)
+
+    if created:
+        conn.execute('ANALYZE')
+        conn.commit()
+    return created
+
+def explain_query_plan(conn, query, params=()):
+    """Return the detail lines of EXPLAIN QUERY PLAN for a query"""
+    return [row[-1] for row in conn.execute(f"EXPLAIN QUERY PLAN {query}", params)]
+
+def plan_warnings(plan, driving_table=None):
+    """Pick the steps of a query plan that scan or sort a whole table
+
+    The driving table of a full export is always scanned, so a SCAN of
+    driving_table (its name or alias) is not reported.
+    """
+    warnings = []
+    for detail in plan:
+        if detail.startswith('SCAN '):
+            table = detail.split()[1]
+            if table == driving_table or 'COVERING INDEX' in detail:
+                continue
+            warnings.append(detail)
+        elif 'USE TEMP B-TREE' in detail:
+            warnings.append(detail)
+    return warnings
@@ -1,14 +1,30 @@
+import argparse
 import sqlite3
 import datetime
 import os
-import random
 import re
 import sys
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
+from functools import lru_cache
+from itertools import islice
+
+from claimState import ClaimChangeTracker
+from claimsDb import PRAGMAS, apply_pragmas, ensure_indexes, explain_query_plan, plan_warnings
+from controlNumbers import ControlNumberAllocator
+from payerProfiles import PayerProfile, PayerRegistry
+from runReport import RunReport
+from validationLog import LOG_FORMATS, ValidationLogWriter
+from validationRules import ErrorLevel, RuleSet, ValidationError, ValidationResults
+from x12Reader import verify_interchange
+from x12Templates import LoopTemplate, Segment
 
 # Configuration
 DB_PATH = 'institutional_claims.db'
 OUTPUT_DIR = 'output_837i_files'
+CONTROL_DB_PATH = 'control_numbers.db'
+STATE_DB_PATH = 'claim_state.db'
 
 # Constants for X12 formatting
 ISA_CONTROL_VERSION = '00501'
@@ -26,457 +42,732 @@ ky_medicaid_requirements = {
     'transaction_type_codes': ['CH', 'RP']  # KY Medicaid only processes claims with "CH" or "RP"
 }
 
-# Validation error levels
-class ErrorLevel:
-    INFO = 'INFO'
-    WARNING = 'WARNING'
-    ERROR = 'ERROR'
-
-class ValidationError:
-    def __init__(self, claim_id, level, message, field=None):
-        self.claim_id = claim_id
-        self.level = level
-        self.message = message
-        self.field = field
-        self.timestamp = datetime.now()
-    
-    def __str__(self):
-        return f"{self.timestamp} - [{self.level}] Claim {self.claim_id}: {self.message}" + \
-               (f" (Field: {self.field})" if self.field else "")
-
-def connect_to_db():
-    """Connect to the SQLite database"""
+# KY Medicaid validation rules, compiled into a RuleSet below. Rule tables
+# for other payers can be kept in JSON files and loaded with RuleSet.load.
+ky_medicaid_rules = {
+    'name': 'KY Medicaid',
+    'rules': [
+        {
+            'field': 'transaction_type_code',  # BHT06
+            'allowed': ky_medicaid_requirements['transaction_type_codes'],
+            'level': ErrorLevel.ERROR,
+            'message': "Invalid transaction type code: {value}. KY Medicaid only accepts 'CH' or 'RP'.",
+        },
+        {
+            'field': 'claim_filing_indicator_code',  # 2000B SBR09
+            'allowed': ['MC'],
+            'level': ErrorLevel.ERROR,
+            'message': "Invalid claim filing indicator code: {value}. KY Medicaid only accepts 'MC'.",
+        },
+        {
+            'field': 'entity_type_qualifier',  # 2010BA NM102
+            'allowed': ['1'],
+            'level': ErrorLevel.ERROR,
+            'message': "Invalid entity type qualifier: {value}. KY Medicaid requires '1' (Person).",
+        },
+        {
+            'field': 'provider_accept_assignment_code',  # 2300 CLM07
+            'allowed': ['A'],
+            'level': ErrorLevel.ERROR,
+            'message': "Invalid provider accept assignment code: {value}. KY Medicaid only accepts 'A'.",
+        },
+        {
+            'field': 'benefits_assignment_cert_indicator',  # 2300 CLM08
+            'allowed': ['Y'],
+            'level': ErrorLevel.ERROR,
+            'message': "Invalid benefits assignment cert indicator: {value}. KY Medicaid only accepts 'Y'.",
+        },
+        {
+            'field': 'release_info_code',  # 2300 CLM09
+            'allowed': ['Y'],
+            'level': ErrorLevel.ERROR,
+            'message': "Invalid release of information code: {value}. KY Medicaid only accepts 'Y'.",
+        },
+        {
+            'field': 'procedure_code_qualifier',  # 2400 SV202-1
+            'scope': 'service_line',
+            'allowed': ['HC'],
+            'level': ErrorLevel.WARNING,
+            'message': "Service line {line_number}: Invalid procedure code qualifier: {value}. KY Medicaid requires 'HC'.",
+        },
+    ],
+    # HI segment notices. In a real implementation, we would check actual HI segment data
+    'advisories': [
+        {
+            # Rule 13: For Principal Procedure Information (BR vs BP)
+            'field': 'HI_segment_principal_procedure',
+            'level': ErrorLevel.INFO,
+            'message': "HI Segment: KY Medicaid only uses HI01-2 when HI01-1 equals BR. If BP is used, value in HI01-2 won't be processed.",
+        },
+        {
+            # Rule 14: For Other Procedure Information (BQ vs BO)
+            'field': 'HI_segment_other_procedure',
+            'level': ErrorLevel.INFO,
+            'message': "HI Segment: KY Medicaid only uses HI01-2 when HI01-1 equals BQ. If BO is used, value in HI01-2 won't be processed.",
+        },
+        {
+            'field': 'HI_segment_HCPCS',
+            'level': ErrorLevel.WARNING,
+            'message': "HI Segment: KY Medicaid prefers HCPCS codes at detail level (SV202-2) with SV202-1='HC'. "
+                       "If HCPCS codes are in HI segment, claim won't fail compliance but may not process correctly.",
+        },
+    ],
+}
+
+KY_MEDICAID_RULES = RuleSet.from_dict(ky_medicaid_rules)
+
+# The payer profile used when no registry is given; it takes every payer
+KY_MEDICAID_PROFILE = PayerProfile(
+    'KY Medicaid',
+    sender_id=ky_medicaid_requirements['sender_id'],
+    receiver_id=ky_medicaid_requirements['receiver_id'],
+    rules=KY_MEDICAID_RULES,
+    submitter_id='KYSUBMIT',
+    file_prefix='837I_KY_MEDICAID',
+)
+
+def connect_to_db(path=DB_PATH, tune=True):
+    """Connect to the SQLite database
+    
+    With tune, read-optimized pragmas are applied and any index the claim
+    loader needs is created if it is missing. Tuning is best effort: on a
+    read-only database a warning is printed and the connection is still
+    returned, and --explain shows which queries lack an index.
+    """
     try:
-        conn = sqlite3.connect(DB_PATH)
+        conn = sqlite3.connect(path)
         conn.row_factory = sqlite3.Row  # Access columns by name
+        if tune:
+            for pragma in PRAGMAS:
+                try:
+                    apply_pragmas(conn, (pragma,))
+                except sqlite3.OperationalError as e:
+                    print(f"Warning: could not set PRAGMA {pragma[0]}: {e}")
+            try:
+                for name in ensure_indexes(conn):
+                    print(f"Created missing index {name}")
+            except sqlite3.OperationalError as e:
+                print(f"Warning: could not create missing indexes: {e}; run with --explain to see the slow queries")
         return conn
     except sqlite3.Error as e:
         print(f"Database connection error: {e}")
         sys.exit(1)
 
-def fetch_claims_data(conn):
-    """Fetch all necessary data for generating 837I files"""
-    cursor = conn.cursor()
+CLAIMS_QUERY = '''
+SELECT c.*, 
+       p.first_name as patient_first_name, p.last_name as patient_last_name,
+       p.gender as patient_gender, p.dob as patient_dob,
+       p.address_line_1 as patient_address_line_1, p.city as patient_city,
+       p.state as patient_state, p.zip_code as patient_zip_code,
+       prov.npi as provider_npi, prov.organization_name as provider_org_name,
+       prov.provider_first_name, prov.provider_last_name,
+       prov.taxonomy_code as provider_taxonomy_code,
+       prov.address_line_1 as provider_address_line_1, 
+       prov.city as provider_city, prov.state as provider_state,
+       prov.zip_code as provider_zip_code, prov.legacy_provider_id,
+       pay.payer_name, pay.payer_id_code,
+       s.insured_first_name, s.insured_last_name, s.insured_id,
+       s.relationship_code, s.policy_number, s.group_number
+FROM claims c
+JOIN patients p ON c.patient_id = p.patient_id
+JOIN providers prov ON c.provider_id = prov.provider_id
+JOIN payers pay ON c.payer_id = pay.payer_id
+JOIN subscribers s ON c.subscriber_id = s.subscriber_id
+'''
+
+SERVICE_LINES_QUERY = '''
+SELECT * FROM service_lines
+WHERE claim_id IS NOT NULL
+ORDER BY claim_id, line_number
+'''
+
+SERVICE_LINES_SINCE_QUERY = '''
+SELECT * FROM service_lines
+WHERE claim_id > ?
+ORDER BY claim_id, line_number
+'''
+
+# Rows pulled from SQLite per fetchmany() call
+FETCH_SIZE = 5000
+
+def _iter_rows(cursor, fetch_size=FETCH_SIZE):
+    """Yield rows of an executed cursor as dicts, fetch_size rows at a time"""
+    columns = [col[0] for col in cursor.description]
+    while True:
+        rows = cursor.fetchmany(fetch_size)
+        if not rows:
+            return
+        for row in rows:
+            yield dict(zip(columns, row))
+
+def iter_claims(conn, fetch_size=FETCH_SIZE, after_claim_id=None):
+    """Stream claims with their service lines attached, ordered by claim_id
     
-    # Get all claims with related data
-    cursor.execute('''
-    SELECT c.*, 
-           p.first_name as patient_first_name, p.last_name as patient_last_name,
-           p.gender as patient_gender, p.dob as patient_dob,
-           p.address_line_1 as patient_address_line_1, p.city as patient_city,
-           p.state as patient_state, p.zip_code as patient_zip_code,
-           prov.npi as provider_npi, prov.organization_name as provider_org_name,
-           prov.provider_first_name, prov.provider_last_name,
-           prov.taxonomy_code as provider_taxonomy_code,
-           prov.address_line_1 as provider_address_line_1, 
-           prov.city as provider_city, prov.state as provider_state,
-           prov.zip_code as provider_zip_code, prov.legacy_provider_id,
-           pay.payer_name, pay.payer_id_code,
-           s.insured_first_name, s.insured_last_name, s.insured_id,
-           s.relationship_code, s.policy_number, s.group_number
-    FROM claims c
-    JOIN patients p ON c.patient_id = p.patient_id
-    JOIN providers prov ON c.provider_id = prov.provider_id
-    JOIN payers pay ON c.payer_id = pay.payer_id
-    JOIN subscribers s ON c.subscriber_id = s.subscriber_id
-    ''')
-    
-    claims = cursor.fetchall()
-    
-    # Fetch service lines for each claim
-    for i, claim in enumerate(claims):
-        cursor.execute('''
-        SELECT * FROM service_lines WHERE claim_id = ?
-        ''', (claim['claim_id'],))
-        service_lines = cursor.fetchall()
-        claims[i] = dict(claim)  # Convert row to dict
-        claims[i]['service_lines'] = [dict(line) for line in service_lines]
-    
-    return claims
-
-def validate_claims(claims):
-    """Validate claims against KY Medicaid requirements"""
-    validation_results = []
-    valid_claims = []
+    Claims and service lines are read with one query each, both sorted by
+    claim_id, and merged in a single pass. Only the claim being assembled is
+    held in memory. With after_claim_id, only claims with a higher claim_id
+    are read.
+    """
+    claim_cursor = conn.cursor()
+    claim_cursor.row_factory = None
+    line_cursor = conn.cursor()
+    line_cursor.row_factory = None
     
-    for claim in claims:
-        claim_errors = []
-        
-        # Check transaction type code (BHT06)
-        if claim['transaction_type_code'] not in ky_medicaid_requirements['transaction_type_codes']:
-            claim_errors.append(
-                ValidationError(
-                    claim['claim_id'], 
-                    ErrorLevel.ERROR, 
-                    f"Invalid transaction type code: {claim['transaction_type_code']}. KY Medicaid only accepts 'CH' or 'RP'.",
-                    'transaction_type_code'
-                )
-            )
-        
-        # Check claim filing indicator code (2000B SBR09)
-        if claim['claim_filing_indicator_code'] != 'MC':
-            claim_errors.append(
-                ValidationError(
-                    claim['claim_id'], 
-                    ErrorLevel.ERROR, 
-                    f"Invalid claim filing indicator code: {claim['claim_filing_indicator_code']}. KY Medicaid only accepts 'MC'.",
-                    'claim_filing_indicator_code'
-                )
-            )
-        
-        # Check entity type qualifier (2010BA NM102)
-        if claim['entity_type_qualifier'] != '1':
-            claim_errors.append(
-                ValidationError(
-                    claim['claim_id'], 
-                    ErrorLevel.ERROR, 
-                    f"Invalid entity type qualifier: {claim['entity_type_qualifier']}. KY Medicaid requires '1' (Person).",
-                    'entity_type_qualifier'
-                )
-            )
-        
-        # Check assignment of benefits indicator (2300 CLM07)
-        if claim['provider_accept_assignment_code'] != 'A':
-            claim_errors.append(
-                ValidationError(
-                    claim['claim_id'], 
-                    ErrorLevel.ERROR, 
-                    f"Invalid provider accept assignment code: {claim['provider_accept_assignment_code']}. KY Medicaid only accepts 'A'.",
-                    'provider_accept_assignment_code'
-                )
-            )
-        
-        # Check benefits assignment cert indicator (2300 CLM08)
-        if claim['benefits_assignment_cert_indicator'] != 'Y':
-            claim_errors.append(
-                ValidationError(
-                    claim['claim_id'], 
-                    ErrorLevel.ERROR, 
-                    f"Invalid benefits assignment cert indicator: {claim['benefits_assignment_cert_indicator']}. KY Medicaid only accepts 'Y'.",
-                    'benefits_assignment_cert_indicator'
-                )
-            )
-        
-        # Check release of information code (2300 CLM09)
-        if claim['release_info_code'] != 'Y':
-            claim_errors.append(
-                ValidationError(
-                    claim['claim_id'], 
-                    ErrorLevel.ERROR, 
-                    f"Invalid release of information code: {claim['release_info_code']}. KY Medicaid only accepts 'Y'.",
-                    'release_info_code'
-                )
-            )
-        
-        # Check procedure code qualifier for each service line (2400 SV202-1)
-        for i, line in enumerate(claim['service_lines']):
-            if line['procedure_code_qualifier'] != 'HC':
-                claim_errors.append(
-                    ValidationError(
-                        claim['claim_id'], 
-                        ErrorLevel.WARNING, 
-                        f"Service line {line['line_number']}: Invalid procedure code qualifier: {line['procedure_code_qualifier']}. KY Medicaid requires 'HC'.",
-                        'procedure_code_qualifier'
-                    )
-                )
+    if after_claim_id is None:
+        claim_cursor.execute(CLAIMS_QUERY + 'ORDER BY c.claim_id')
+        line_cursor.execute(SERVICE_LINES_QUERY)
+    else:
+        claim_cursor.execute(CLAIMS_QUERY + 'WHERE c.claim_id > ? ORDER BY c.claim_id', (after_claim_id,))
+        line_cursor.execute(SERVICE_LINES_SINCE_QUERY, (after_claim_id,))
+    
+    lines = _iter_rows(line_cursor, fetch_size)
+    line = next(lines, None)
+    
+    for claim in _iter_rows(claim_cursor, fetch_size):
+        claim_id = claim['claim_id']
         
-        # Add HI segment validation (Principal Procedure and Other Procedure Information)
-        # In a real implementation, we would check actual HI segment data
-        # As a placeholder, we'll add informational warnings
+        # Skip lines of claims dropped by the join
+        while line is not None and line['claim_id'] < claim_id:
+            line = next(lines, None)
         
-        # Rule 13: For Principal Procedure Information (BR vs BP)
-        claim_errors.append(
-            ValidationError(
-                claim['claim_id'],
-                ErrorLevel.INFO,
-                "HI Segment: KY Medicaid only uses HI01-2 when HI01-1 equals BR. If BP is used, value in HI01-2 won't be processed.",
-                'HI_segment_principal_procedure'
-            )
-        )
-        
-        # Rule 14: For Other Procedure Information (BQ vs BO)
-        claim_errors.append(
-            ValidationError(
-                claim['claim_id'],
-                ErrorLevel.INFO,
-                "HI Segment: KY Medicaid only uses HI01-2 when HI01-1 equals BQ. If BO is used, value in HI01-2 won't be processed.",
-                'HI_segment_other_procedure'
-            )
-        )
+        service_lines = []
+        while line is not None and line['claim_id'] == claim_id:
+            service_lines.append(line)
+            line = next(lines, None)
         
-        # Add warning about HCPCS codes in HI segment
-        claim_errors.append(
-            ValidationError(
-                claim['claim_id'],
-                ErrorLevel.WARNING,
-                "HI Segment: KY Medicaid prefers HCPCS codes at detail level (SV202-2) with SV202-1='HC'. " +
-                "If HCPCS codes are in HI segment, claim won't fail compliance but may not process correctly.",
-                'HI_segment_HCPCS'
-            )
-        )
+        claim['service_lines'] = service_lines
+        yield claim
+
+def explain_loader_queries(conn):
+    """Return the query plan of each loader query and the steps that scan or sort
+    
+    Maps each query name to (plan, warnings). The claims table drives the
+    export and is expected to be scanned; every join should be an index
+    search and neither query should need a temporary sort.
+    """
+    queries = (
+        ('claims', CLAIMS_QUERY + 'ORDER BY c.claim_id', 'c'),
+        ('service_lines', SERVICE_LINES_QUERY, 'service_lines'),
+    )
+    plans = {}
+    for name, query, driving_table in queries:
+        plan = explain_query_plan(conn, query)
+        plans[name] = (plan, plan_warnings(plan, driving_table))
+    return plans
+
+def fetch_claims_data(conn, after_claim_id=None):
+    """Fetch all necessary data for generating 837I files"""
+    return list(iter_claims(conn, after_claim_id=after_claim_id))
+
+def has_errors(claim_errors):
+    """Check whether any validation result is an ERROR"""
+    return any(e.level == ErrorLevel.ERROR for e in claim_errors)
+
+def validate_claims(claims, rules=KY_MEDICAID_RULES, validation_results=None):
+    """Validate claims against KY Medicaid requirements
+    
+    Results are added to validation_results as each claim is checked, so a
+    ValidationLogWriter can be passed to log them as they are found.
+    """
+    if validation_results is None:
+        validation_results = ValidationResults()
+    validation_results.extend(rules.advisories())
+    valid_claims = []
+    
+    for claim in claims:
+        claim_errors = rules.validate(claim)
         
         # Store validation results
         validation_results.extend(claim_errors)
         
         # If no errors, add to valid claims
-        if not any(e.level == ErrorLevel.ERROR for e in claim_errors):
+        if not has_errors(claim_errors):
             valid_claims.append(claim)
         
     return valid_claims, validation_results
 
-def generate_control_numbers():
-    """Generate X12 control numbers"""
-    isa_control_number = str(random.randint(1, 999999)).zfill(9)
-    gs_control_number = str(random.randint(1, 999999)).zfill(9)
-    st_control_number = str(random.randint(1, 9999)).zfill(4)
-    return isa_control_number, gs_control_number, st_control_number
+def _fetch_columns(cursor, fields):
+    """Fetch the rows of a query on fields as a dict of columns, empty ones if there are no rows"""
+    rows = cursor.fetchall()
+    if not rows:
+        return {field: () for field in fields}
+    return dict(zip(fields, zip(*rows)))
 
-def format_date(date_str, format_in='%Y-%m-%d', format_out='%Y%m%d'):
-    """Convert date format"""
-    if not date_str:
-        return ''
+def validate_claims_columnar(conn, rules=KY_MEDICAID_RULES):
+    """Validate every claim in the database column by column
+    
+    Only the columns the rules read are loaded, straight into arrays, and
+    each rule is computed over the whole table as a boolean mask. Returns
+    the number of claims, the set of claim_ids that failed with an ERROR
+    and the validation results, which match what validate_claims reports
+    for the same claims. Requires numpy and pandas.
+    """
+    claim_fields, line_fields = rules.columns()
+    
+    cursor = conn.cursor()
+    cursor.row_factory = None
+    cursor.execute(f"SELECT {', '.join(claim_fields)} FROM ({CLAIMS_QUERY}) ORDER BY claim_id")
+    claim_columns = _fetch_columns(cursor, claim_fields)
+    
+    line_columns = None
+    if line_fields:
+        cursor.execute(f"SELECT {', '.join(line_fields)} FROM service_lines "
+                       "WHERE claim_id IS NOT NULL ORDER BY claim_id, line_number")
+        line_columns = _fetch_columns(cursor, line_fields)
+    
+    claim_ids = claim_columns['claim_id']
+    invalid, claim_errors = rules.validate_columns(claim_columns, line_columns)
+    invalid_ids = {claim_id for claim_id, is_invalid in zip(claim_ids, invalid) if is_invalid}
+    return len(claim_ids), invalid_ids, ValidationResults(rules.advisories() + claim_errors)
+
+def iter_valid_claims(claims, validation_results, stats=None, rules=KY_MEDICAID_RULES):
+    """Validate claims one at a time and yield the ones without errors
+    
+    Each claim's validation results, including the subscriber checks run on
+    valid claims, are handed to validation_results.extend as soon as the
+    claim is checked, so a streaming log writer can be used in place of a
+    list. stats, if given, gets running 'total' and 'valid' claim counts.
+    """
+    if stats is None:
+        stats = {}
+    stats.setdefault('total', 0)
+    stats.setdefault('valid', 0)
+    
+    validation_results.extend(rules.advisories())
+    for claim in claims:
+        stats['total'] += 1
+        claim_errors = rules.validate(claim)
+        
+        if has_errors(claim_errors):
+            validation_results.extend(claim_errors)
+            continue
+        
+        claim_errors.extend(validate_subscriber_info((claim,)))
+        validation_results.extend(claim_errors)
+        stats['valid'] += 1
+        yield claim
+
+def format_control_numbers(control_number):
+    """ISA, GS and ST control numbers for an interchange with one group and one transaction set"""
+    return str(control_number).zfill(9), str(control_number).zfill(9), str(control_number).zfill(4)
+
+# Distinct dates kept by the format_date cache
+DATE_CACHE_SIZE = 65536
+
+@lru_cache(maxsize=DATE_CACHE_SIZE)
+def _format_iso_date(date_str):
+    """Convert YYYY-MM-DD to YYYYMMDD by slicing, checking it is a real date"""
+    if (len(date_str) == 10 and date_str[4] == '-' and date_str[7] == '-' and date_str.isascii()
+            and date_str[:4].isdigit() and date_str[5:7].isdigit() and date_str[8:].isdigit()):
+        try:
+            datetime(int(date_str[:4]), int(date_str[5:7]), int(date_str[8:]))
+        except ValueError:
+            return date_str
+        return date_str[:4] + date_str[5:7] + date_str[8:]
+    # Anything else strptime would accept, such as unpadded months, takes the slow path
+    return _convert_date(date_str, '%Y-%m-%d', '%Y%m%d')
+
+def _convert_date(date_str, format_in, format_out):
     try:
         dt = datetime.strptime(date_str, format_in)
         return dt.strftime(format_out)
     except ValueError:
         return date_str
 
-def generate_837i_file(claims, batch_size=100):
-    """Generate X12 837I file for KY Medicaid"""
-    if not claims:
-        print("No valid claims to process")
-        return []
+def format_date(date_str, format_in='%Y-%m-%d', format_out='%Y%m%d'):
+    """Convert date format
+    
+    The default YYYY-MM-DD to YYYYMMDD conversion is done by string slicing
+    and cached, since claims repeat the same dates heavily.
+    """
+    if not date_str:
+        return ''
+    if format_in == '%Y-%m-%d' and format_out == '%Y%m%d' and type(date_str) is str:
+        return _format_iso_date(date_str)
+    return _convert_date(date_str, format_in, format_out)
+
+# Rendered size of the parts of an interchange, measured on typical claims.
+# Segment counts are exact; byte sizes are estimates within a few percent.
+ENVELOPE_SEGMENTS = 10  # ISA, GS, ST, BHT, 1000A NM1 and PER, 1000B NM1, SE, GE, IEA
+ENVELOPE_BYTES = 450
+CLAIM_SEGMENTS = 18  # 2000A, 2000B/2010BA/2010BB and 2300 loops
+CLAIM_BYTES = 460
+SERVICE_LINE_SEGMENTS = 3
+SERVICE_LINE_BYTES = 60
+PROVIDER_SEGMENT_BYTES = 40  # each 2310 referring or attending provider segment
+
+def estimate_837i_claim(claim):
+    """Estimate the bytes and count the segments one claim adds to an 837I"""
+    lines = len(claim['service_lines'])
+    provider_segments = (1 if claim['referring_provider_npi'] else 0) + (2 if claim['attending_provider_npi'] else 0)
+    return (
+        CLAIM_BYTES + lines * SERVICE_LINE_BYTES + provider_segments * PROVIDER_SEGMENT_BYTES,
+        CLAIM_SEGMENTS + lines * SERVICE_LINE_SEGMENTS + provider_segments,
+    )
+
+class ClaimBatcher:
+    """Collect claims into interchange-sized batches
+    
+    A batch is cut at max_claims claims, or before a claim that would take
+    it past max_bytes (estimated) or max_segments, counting the envelope. A
+    claim too big for the limits on its own still gets a batch to itself.
+    """
+    def __init__(self, max_claims, max_bytes=None, max_segments=None):
+        self.max_claims = max_claims
+        self.max_bytes = max_bytes
+        self.max_segments = max_segments
+        self.batch = []
+        self.bytes = ENVELOPE_BYTES
+        self.segments = ENVELOPE_SEGMENTS
+    
+    def add(self, claim):
+        """Add a claim, returning the previous batch if this claim did not fit in it"""
+        claim_bytes, claim_segments = estimate_837i_claim(claim) if self.max_bytes or self.max_segments else (0, 0)
+        full = None
+        if self.batch and (
+            len(self.batch) >= self.max_claims or
+            (self.max_bytes and self.bytes + claim_bytes > self.max_bytes) or
+            (self.max_segments and self.segments + claim_segments > self.max_segments)
+        ):
+            full = self.take()
+        
+        self.batch.append(claim)
+        self.bytes += claim_bytes
+        self.segments += claim_segments
+        return full
+    
+    def take(self):
+        """Return the current batch and start a new one"""
+        batch = self.batch
+        self.batch = []
+        self.bytes = ENVELOPE_BYTES
+        self.segments = ENVELOPE_SEGMENTS
+        return batch
+
+def iter_batches(claims, batch_size, max_bytes=None, max_segments=None):
+    """Group an iterable of claims into lists of at most batch_size claims
+    
+    With max_bytes or max_segments, batches are also cut to stay within
+    those limits as ClaimBatcher does.
+    """
+    claims = iter(claims)
+    if not (max_bytes or max_segments):
+        while True:
+            batch = list(islice(claims, batch_size))
+            if not batch:
+                return
+            yield batch
+    
+    batcher = ClaimBatcher(batch_size, max_bytes, max_segments)
+    for claim in claims:
+        batch = batcher.add(claim)
+        if batch:
+            yield batch
+    if batcher.batch:
+        yield batcher.take()
+
+class SegmentWriter:
+    """Build an X12 interchange in memory, one segment at a time
+    
+    The number of segments between ST and SE is counted as segments are
+    added, so the SE trailer can be written directly and the whole
+    interchange is written to disk with a single write.
+    """
+    def __init__(self):
+        self.segments = []
+        self.segment_count = 0
+    
+    def add(self, *elements):
+        """Append a segment built from its elements"""
+        self.segments.append(ELEMENT_SEPARATOR.join(map(str, elements)))
+        self.segment_count += 1
+    
+    def start_transaction(self, st_control_number):
+        """Write the ST header and restart the transaction set segment count"""
+        self.segment_count = 0
+        self.add('ST', '837', st_control_number, GS_VERSION)
+    
+    def add_rendered(self, text, count):
+        """Append count segments already rendered and joined, e.g. by a LoopTemplate"""
+        if count:
+            self.segments.append(text)
+            self.segment_count += count
+    
+    def end_transaction(self, st_control_number):
+        """Write the SE trailer with the number of segments from ST to SE inclusive"""
+        self.add('SE', self.segment_count + 1, st_control_number)
+    
+    def getvalue(self):
+        return (SEGMENT_TERMINATOR + LINE_BREAK).join(self.segments) + SEGMENT_TERMINATOR
+    
+    def write(self, file_path):
+        """Write the interchange, refusing to replace an existing file"""
+        with open(file_path, 'x') as f:
+            f.write(self.getvalue())
+
+def _loop(name, *segments):
+    return LoopTemplate(name, segments, ELEMENT_SEPARATOR, SUB_ELEMENT_SEPARATOR, SEGMENT_TERMINATOR, LINE_BREAK)
+
+# 837I claim loops, compiled once. Values come from the claim or service
+# line, plus the computed values set in render_837i_claim.
+LOOP_2000A = _loop(
+    '2000A Billing Provider',
+    Segment('HL*{provider_hl}**20*1'),
+    Segment('NM1*85*2*{provider_org_name}*****XX*{provider_npi}', when='provider_org_name'),
+    Segment('NM1*85*1*{provider_last_name}*{provider_first_name}*****XX*{provider_npi}', unless='provider_org_name'),
+    Segment('N3*{provider_address_line_1}'),
+    Segment('N4*{provider_city}*{provider_state}*{provider_zip_code}'),
+    Segment('PRV*BI*PXC*{provider_taxonomy_code}'),
+)
+
+LOOP_2000B = _loop(
+    '2000B Subscriber, 2010BA Subscriber Name, 2010BB Payer Name',
+    Segment('HL*{subscriber_hl}*{provider_hl}*22*0'),
+    Segment('SBR*P*{relationship_code}*{group_number}*****{claim_filing_indicator_code}'),
+    Segment('NM1*IL*{entity_type_qualifier}*{insured_last_name}*{insured_first_name}****MI*{insured_id}'),
+    Segment('N3*{patient_address_line_1}'),
+    Segment('N4*{patient_city}*{patient_state}*{patient_zip_code}'),
+    Segment('DMG*D8*{patient_dob_d8}*{patient_gender}'),
+    Segment('NM1*PR*2*{profile_payer_name}*****PI*{profile_payer_id}'),
+)
+
+LOOP_2300 = _loop(
+    '2300 Claim Information',
+    Segment('CLM*{patient_control_number}*{claim_amount}*****{provider_accept_assignment_code}'
+            '*{benefits_assignment_cert_indicator}*{release_info_code}'),
+    Segment('CL1*{place_of_service_code}*{claim_frequency_type_code}*{patient_status_code}'),
+    Segment('DTP*435*D8*{admission_date_d8}'),
+    Segment('DTP*096*D8*{discharge_date_d8}'),
+    Segment('DTP*434*RD8*{statement_from_date_d8}-{statement_to_date_d8}'),
+    Segment('HI*{diagnoses}'),
+)
+
+LOOP_2400 = _loop(
+    '2400 Service Line',
+    Segment('LX*{line_number}'),
+    Segment('SV2*{revenue_code}*{procedure_code_qualifier}:{procedure_code}*{charge_amount}*UN*{units}'),
+    Segment('DTP*472*D8*{service_date_d8}'),
+)
+
+LOOP_2310 = _loop(
+    '2310 Referring and Attending Providers',
+    Segment('NM1*DN*1*REFERRING*PROVIDER****XX*{referring_provider_npi}', when='referring_provider_npi'),
+    Segment('NM1*71*1*ATTENDING*PROVIDER****XX*{attending_provider_npi}', when='attending_provider_npi'),
+    Segment('PRV*AT*PXC*{provider_taxonomy_code}', when='attending_provider_npi'),
+)
+
+def render_837i_claim(claim, hierarchical_id, profile=KY_MEDICAID_PROFILE):
+    """Render one claim's loops as a single string and return (text, segment count)
+    
+    The claim's billing provider HL gets hierarchical_id and its subscriber
+    HL the next number. The 2010BB payer comes from profile.
+    """
+    # Principal Diagnosis, then up to 8 secondary diagnoses if present
+    diagnoses = [f"ABK{SUB_ELEMENT_SEPARATOR}{claim['principal_diagnosis_code']}"]
+    if claim['secondary_diagnosis_codes']:
+        secondary_codes = claim['secondary_diagnosis_codes'].split(',')[:8]
+        diagnoses.extend(f"ABF{SUB_ELEMENT_SEPARATOR}{code.strip()}" for code in secondary_codes)
+    
+    # A flat copy keeps every lookup in format_map inside the dict itself
+    values = dict(
+        claim,
+        provider_hl=hierarchical_id,
+        subscriber_hl=hierarchical_id + 1,
+        group_number=claim['group_number'] or '',
+        patient_dob_d8=format_date(claim['patient_dob']),
+        admission_date_d8=format_date(claim['admission_date']),
+        discharge_date_d8=format_date(claim['discharge_date']),
+        statement_from_date_d8=format_date(claim['statement_from_date']),
+        statement_to_date_d8=format_date(claim['statement_to_date']),
+        diagnoses=ELEMENT_SEPARATOR.join(diagnoses),
+        profile_payer_name=profile.payer_name,
+        profile_payer_id=profile.payer_id,
+    )
+    
+    texts = []
+    count = 0
+    for loop in (LOOP_2000A, LOOP_2000B, LOOP_2300):
+        text, segment_count = loop.render(values)
+        texts.append(text)
+        count += segment_count
+    
+    for line in claim['service_lines']:
+        text, segment_count = LOOP_2400.render(dict(line, service_date_d8=format_date(line['service_date'])))
+        texts.append(text)
+        count += segment_count
+    
+    text, segment_count = LOOP_2310.render(values)
+    if segment_count:
+        texts.append(text)
+        count += segment_count
+    
+    return (SEGMENT_TERMINATOR + LINE_BREAK).join(texts), count
+
+def write_837i_batch(batch, control_number, now=None, profile=KY_MEDICAID_PROFILE):
+    """Write one batch of claims as an X12 837I interchange and return its path
+    
+    now may be passed in so that batches rendered in worker processes share
+    the run's file date. Envelope IDs, submitter and receiver names and the
+    file name prefix come from profile; the name ends with the ISA13 control
+    number, and an existing file is never overwritten.
+    """
+    # Format control numbers
+    isa_control_number, gs_control_number, st_control_number = format_control_numbers(control_number)
+    
+    # Current date and time in appropriate formats
+    if now is None:
+        now = datetime.now()
+    now_date = now.strftime('%Y%m%d')
+    now_time = now.strftime('%H%M')
+    
+    # File naming: ISA13 makes the name unique per interchange, so a later
+    # run on the same day never replaces files whose claims were submitted
+    file_name = f"{profile.file_prefix}_{now_date}_{isa_control_number}.txt"
+    file_path = os.path.join(OUTPUT_DIR, file_name)
+    
+    sender_id = profile.sender_id
+    receiver_id = profile.receiver_id
+    w = SegmentWriter()
+    
+    # ISA - Interchange Control Header
+    w.add('ISA', '00', ' ' * 10, '00', ' ' * 10, 'ZZ', sender_id.ljust(15), 'ZZ', receiver_id.ljust(15),
+          now_date, now_time, '^', ISA_CONTROL_VERSION, isa_control_number, '0', 'P', SUB_ELEMENT_SEPARATOR)
+    
+    # GS - Functional Group Header
+    w.add('GS', 'HC', sender_id, receiver_id, now_date, now_time, gs_control_number, 'X', GS_VERSION)
+    
+    # ST - Transaction Set Header
+    w.start_transaction(st_control_number)
+    
+    # BHT - Beginning of Hierarchical Transaction
+    w.add('BHT', '0019', '00', batch[0]['claim_control_number'], now_date, now_time, batch[0]['transaction_type_code'])
+    
+    # 1000A Submitter Loop
+    w.add('NM1', '41', '2', sender_id, '', '', '', '', '46', profile.submitter_id)
+    
+    # Submitter EDI Contact Information
+    w.add('PER', 'IC', profile.contact_name, 'TE', profile.contact_phone)
+    
+    # 1000B Receiver Loop
+    w.add('NM1', '40', '2', profile.receiver_name, '', '', '', '', '46', receiver_id)
+    
+    # Loop counter for hierarchical IDs
+    hierarchical_id = 1
+    
+    # Process each claim
+    for claim in batch:
+        w.add_rendered(*render_837i_claim(claim, hierarchical_id, profile))
+        hierarchical_id += 2
+    
+    # SE - Transaction Set Trailer
+    w.end_transaction(st_control_number)
+    
+    # GE - Functional Group Trailer
+    w.add('GE', '1', gs_control_number)
+    
+    # IEA - Interchange Control Trailer
+    w.add('IEA', '1', isa_control_number)
+    
+    w.write(file_path)
+    
+    print(f"Generated 837I file: {file_path} with {len(batch)} claims")
+    
+    return file_path
+
+def generate_837i_file(claims, batch_size=None, workers=None, allocator=None, profile=KY_MEDICAID_PROFILE):
+    """Generate X12 837I file for KY Medicaid
+    
+    claims may be a list or any iterable, such as a generator of validated
+    claims; only one batch of claims is held in memory at a time. With
+    workers > 1 the batches are rendered in a process pool instead.
+    
+    Control numbers come from allocator, a ControlNumberAllocator, and each
+    one is recorded against its output file. By default the allocator
+    persists its counter in CONTROL_DB_PATH. Interchanges are written for
+    profile, whose batch size is used unless batch_size is given, and are
+    also cut to stay within the profile's max_bytes and max_segments.
+    """
+    if batch_size is None:
+        batch_size = profile.batch_size
     
     # Create output directory if it doesn't exist
     if not os.path.exists(OUTPUT_DIR):
         os.makedirs(OUTPUT_DIR)
     
-    # Process claims in batches
-    batches = [claims[i:i+batch_size] for i in range(0, len(claims), batch_size)]
+    owns_allocator = allocator is None
+    if owns_allocator:
+        allocator = ControlNumberAllocator(CONTROL_DB_PATH, sender_id=profile.sender_id)
+    
+    try:
+        # Process claims in batches
+        if workers and workers > 1:
+            file_paths = generate_837i_parallel(claims, batch_size, workers, allocator, profile)
+        else:
+            file_paths = []
+            batches = iter_batches(claims, batch_size, profile.max_bytes, profile.max_segments)
+            for batch in batches:
+                control_number = allocator.next()
+                file_path = write_837i_batch(batch, control_number, profile=profile)
+                allocator.record(control_number, file_path)
+                file_paths.append(file_path)
+    finally:
+        if owns_allocator:
+            allocator.close()
+    
+    if not file_paths:
+        print("No valid claims to process")
+    
+    return file_paths
+
+def generate_837i_parallel(claims, batch_size, workers, allocator, profile=KY_MEDICAID_PROFILE):
+    """Render 837I batches in a process pool, one batch per task
+    
+    Control numbers and the file date are fixed in this process before a
+    batch is handed out, so output names and numbers do not depend on which
+    worker finishes first. At most two batches per worker are in flight,
+    which keeps memory bounded when claims is a stream.
+    """
+    now = datetime.now()
     file_paths = []
+    pending = deque()
     
-    for batch_num, batch in enumerate(batches):
-        # Generate control numbers
-        isa_control_number, gs_control_number, st_control_number = generate_control_numbers()
-        
-        # Current date and time in appropriate formats
-        now = datetime.now()
-        now_date = now.strftime('%Y%m%d')
-        now_time = now.strftime('%H%M')
-        
-        # File naming
-        file_name = f"837I_KY_MEDICAID_{now_date}_{batch_num+1}.txt"
-        file_path = os.path.join(OUTPUT_DIR, file_name)
+    def collect():
+        control_number, future = pending.popleft()
+        file_path = future.result()
+        allocator.record(control_number, file_path)
         file_paths.append(file_path)
+    
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        batches = iter_batches(claims, batch_size, profile.max_bytes, profile.max_segments)
+        for batch in batches:
+            control_number = allocator.next()
+            pending.append((
+                control_number, pool.submit(write_837i_batch, batch, control_number, now, profile)
+            ))
+            if len(pending) >= workers * 2:
+                collect()
         
-        with open(file_path, 'w') as f:
-            # ISA - Interchange Control Header
-            isa = f"ISA{ELEMENT_SEPARATOR}00{ELEMENT_SEPARATOR}          {ELEMENT_SEPARATOR}00{ELEMENT_SEPARATOR}          "
-            isa += f"{ELEMENT_SEPARATOR}ZZ{ELEMENT_SEPARATOR}{ky_medicaid_requirements['sender_id'].ljust(15)}"
-            isa += f"{ELEMENT_SEPARATOR}ZZ{ELEMENT_SEPARATOR}{ky_medicaid_requirements['receiver_id'].ljust(15)}"
-            isa += f"{ELEMENT_SEPARATOR}{now_date}{ELEMENT_SEPARATOR}{now_time}"
-            isa += f"{ELEMENT_SEPARATOR}^{ELEMENT_SEPARATOR}{ISA_CONTROL_VERSION}{ELEMENT_SEPARATOR}{isa_control_number}"
-            isa += f"{ELEMENT_SEPARATOR}0{ELEMENT_SEPARATOR}P{ELEMENT_SEPARATOR}{SUB_ELEMENT_SEPARATOR}{SEGMENT_TERMINATOR}{LINE_BREAK}"
-            f.write(isa)
-            
-            # GS - Functional Group Header
-            gs = f"GS{ELEMENT_SEPARATOR}HC{ELEMENT_SEPARATOR}{ky_medicaid_requirements['sender_id']}"
-            gs += f"{ELEMENT_SEPARATOR}{ky_medicaid_requirements['receiver_id']}"
-            gs += f"{ELEMENT_SEPARATOR}{now_date}{ELEMENT_SEPARATOR}{now_time}"
-            gs += f"{ELEMENT_SEPARATOR}{gs_control_number}{ELEMENT_SEPARATOR}X{ELEMENT_SEPARATOR}{GS_VERSION}{SEGMENT_TERMINATOR}{LINE_BREAK}"
-            f.write(gs)
-            
-            # ST - Transaction Set Header
-            st = f"ST{ELEMENT_SEPARATOR}837{ELEMENT_SEPARATOR}{st_control_number}{ELEMENT_SEPARATOR}{GS_VERSION}{SEGMENT_TERMINATOR}{LINE_BREAK}"
-            f.write(st)
-            
-            # BHT - Beginning of Hierarchical Transaction
-            bht = f"BHT{ELEMENT_SEPARATOR}0019{ELEMENT_SEPARATOR}00{ELEMENT_SEPARATOR}{batch[0]['claim_control_number']}"
-            bht += f"{ELEMENT_SEPARATOR}{now_date}{ELEMENT_SEPARATOR}{now_time}"
-            bht += f"{ELEMENT_SEPARATOR}{batch[0]['transaction_type_code']}{SEGMENT_TERMINATOR}{LINE_BREAK}"
-            f.write(bht)
-            
-            # 1000A Submitter Loop
-            f.write(f"NM1{ELEMENT_SEPARATOR}41{ELEMENT_SEPARATOR}2{ELEMENT_SEPARATOR}{ky_medicaid_requirements['sender_id']}")
-            f.write(f"{ELEMENT_SEPARATOR}{ELEMENT_SEPARATOR}{ELEMENT_SEPARATOR}{ELEMENT_SEPARATOR}{ELEMENT_SEPARATOR}46")
-            f.write(f"{ELEMENT_SEPARATOR}KYSUBMIT{SEGMENT_TERMINATOR}{LINE_BREAK}")
-            
-            # Submitter EDI Contact Information
-            f.write(f"PER{ELEMENT_SEPARATOR}IC{ELEMENT_SEPARATOR}SUBMITTER CONTACT{ELEMENT_SEPARATOR}TE")
-            f.write(f"{ELEMENT_SEPARATOR}8005551234{SEGMENT_TERMINATOR}{LINE_BREAK}")
-            
-            # 1000B Receiver Loop
-            f.write(f"NM1{ELEMENT_SEPARATOR}40{ELEMENT_SEPARATOR}2{ELEMENT_SEPARATOR}KYMEDICAID")
-            f.write(f"{ELEMENT_SEPARATOR}{ELEMENT_SEPARATOR}{ELEMENT_SEPARATOR}{ELEMENT_SEPARATOR}{ELEMENT_SEPARATOR}46")
-            f.write(f"{ELEMENT_SEPARATOR}KYMEDICAID{SEGMENT_TERMINATOR}{LINE_BREAK}")
-            
-            # Loop counter for hierarchical IDs
-            hierarchical_id = 1
-            
-            # Process each claim
-            for claim in batch:
-                # 2000A Billing Provider Hierarchical Level
-                f.write(f"HL{ELEMENT_SEPARATOR}{hierarchical_id}{ELEMENT_SEPARATOR}{ELEMENT_SEPARATOR}20")
-                f.write(f"{ELEMENT_SEPARATOR}1{SEGMENT_TERMINATOR}{LINE_BREAK}")
-                
-                provider_hierarchical_id = hierarchical_id
-                hierarchical_id += 1
-                
-                # Billing Provider Name
-                if claim['provider_org_name']:
-                    # Organization
-                    f.write(f"NM1{ELEMENT_SEPARATOR}85{ELEMENT_SEPARATOR}2{ELEMENT_SEPARATOR}{claim['provider_org_name']}")
-                else:
-                    # Individual
-                    f.write(f"NM1{ELEMENT_SEPARATOR}85{ELEMENT_SEPARATOR}1{ELEMENT_SEPARATOR}{claim['provider_last_name']}")
-                    f.write(f"{ELEMENT_SEPARATOR}{claim['provider_first_name']}")
-                
-                f.write(f"{ELEMENT_SEPARATOR}{ELEMENT_SEPARATOR}{ELEMENT_SEPARATOR}{ELEMENT_SEPARATOR}{ELEMENT_SEPARATOR}XX")
-                f.write(f"{ELEMENT_SEPARATOR}{claim['provider_npi']}{SEGMENT_TERMINATOR}{LINE_BREAK}")
-                
-                # Billing Provider Address
-                f.write(f"N3{ELEMENT_SEPARATOR}{claim['provider_address_line_1']}{SEGMENT_TERMINATOR}{LINE_BREAK}")
-                f.write(f"N4{ELEMENT_SEPARATOR}{claim['provider_city']}{ELEMENT_SEPARATOR}{claim['provider_state']}")
-                f.write(f"{ELEMENT_SEPARATOR}{claim['provider_zip_code']}{SEGMENT_TERMINATOR}{LINE_BREAK}")
-                
-                # Billing Provider Taxonomy
-                f.write(f"PRV{ELEMENT_SEPARATOR}BI{ELEMENT_SEPARATOR}PXC{ELEMENT_SEPARATOR}{claim['provider_taxonomy_code']}")
-                f.write(f"{SEGMENT_TERMINATOR}{LINE_BREAK}")
-                
-                # 2000B Subscriber Hierarchical Level
-                f.write(f"HL{ELEMENT_SEPARATOR}{hierarchical_id}{ELEMENT_SEPARATOR}{provider_hierarchical_id}")
-                f.write(f"{ELEMENT_SEPARATOR}22{ELEMENT_SEPARATOR}0{SEGMENT_TERMINATOR}{LINE_BREAK}")
-                
-                hierarchical_id += 1
-                
-                # Subscriber Information
-                f.write(f"SBR{ELEMENT_SEPARATOR}P{ELEMENT_SEPARATOR}{claim['relationship_code']}")
-                f.write(f"{ELEMENT_SEPARATOR}{claim['group_number'] or ''}{ELEMENT_SEPARATOR}{ELEMENT_SEPARATOR}{ELEMENT_SEPARATOR}")
-                f.write(f"{ELEMENT_SEPARATOR}{ELEMENT_SEPARATOR}{claim['claim_filing_indicator_code']}")
-                f.write(f"{SEGMENT_TERMINATOR}{LINE_BREAK}")
-                
-                # Subscriber Name (2010BA)
-                f.write(f"NM1{ELEMENT_SEPARATOR}IL{ELEMENT_SEPARATOR}{claim['entity_type_qualifier']}")
-                f.write(f"{ELEMENT_SEPARATOR}{claim['insured_last_name']}{ELEMENT_SEPARATOR}{claim['insured_first_name']}")
-                f.write(f"{ELEMENT_SEPARATOR}{ELEMENT_SEPARATOR}{ELEMENT_SEPARATOR}{ELEMENT_SEPARATOR}MI")
-                f.write(f"{ELEMENT_SEPARATOR}{claim['insured_id']}{SEGMENT_TERMINATOR}{LINE_BREAK}")
-                
-                # Subscriber Address
-                f.write(f"N3{ELEMENT_SEPARATOR}{claim['patient_address_line_1']}{SEGMENT_TERMINATOR}{LINE_BREAK}")
-                f.write(f"N4{ELEMENT_SEPARATOR}{claim['patient_city']}{ELEMENT_SEPARATOR}{claim['patient_state']}")
-                f.write(f"{ELEMENT_SEPARATOR}{claim['patient_zip_code']}{SEGMENT_TERMINATOR}{LINE_BREAK}")
-                
-                # Subscriber Demographic Info
-                subscriber_dob = format_date(claim['patient_dob'])
-                f.write(f"DMG{ELEMENT_SEPARATOR}D8{ELEMENT_SEPARATOR}{subscriber_dob}")
-                f.write(f"{ELEMENT_SEPARATOR}{claim['patient_gender']}{SEGMENT_TERMINATOR}{LINE_BREAK}")
-                
-                # Payer Name (2010BB)
-                f.write(f"NM1{ELEMENT_SEPARATOR}PR{ELEMENT_SEPARATOR}2{ELEMENT_SEPARATOR}KYMEDICAID")
-                f.write(f"{ELEMENT_SEPARATOR}{ELEMENT_SEPARATOR}{ELEMENT_SEPARATOR}{ELEMENT_SEPARATOR}{ELEMENT_SEPARATOR}PI")
-                f.write(f"{ELEMENT_SEPARATOR}KYMEDICAID{SEGMENT_TERMINATOR}{LINE_BREAK}")
-                
-                # 2300 Claim Information
-                f.write(f"CLM{ELEMENT_SEPARATOR}{claim['patient_control_number']}{ELEMENT_SEPARATOR}{claim['claim_amount']}")
-                f.write(f"{ELEMENT_SEPARATOR}{ELEMENT_SEPARATOR}{ELEMENT_SEPARATOR}{ELEMENT_SEPARATOR}{ELEMENT_SEPARATOR}")
-                f.write(f"{claim['provider_accept_assignment_code']}{ELEMENT_SEPARATOR}{claim['benefits_assignment_cert_indicator']}")
-                f.write(f"{ELEMENT_SEPARATOR}{claim['release_info_code']}{SEGMENT_TERMINATOR}{LINE_BREAK}")
-                
-                # Facility Type Code & Claim Frequency
-                f.write(f"CL1{ELEMENT_SEPARATOR}{claim['place_of_service_code']}")
-                f.write(f"{ELEMENT_SEPARATOR}{claim['claim_frequency_type_code']}")
-                f.write(f"{ELEMENT_SEPARATOR}{claim['patient_status_code']}{SEGMENT_TERMINATOR}{LINE_BREAK}")
-                
-                # Admission Date and Hour
-                admission_date = format_date(claim['admission_date'])
-                discharge_date = format_date(claim['discharge_date'])
-                f.write(f"DTP{ELEMENT_SEPARATOR}435{ELEMENT_SEPARATOR}D8{ELEMENT_SEPARATOR}{admission_date}")
-                f.write(f"{SEGMENT_TERMINATOR}{LINE_BREAK}")
-                
-                # Discharge Date and Hour
-                f.write(f"DTP{ELEMENT_SEPARATOR}096{ELEMENT_SEPARATOR}D8{ELEMENT_SEPARATOR}{discharge_date}")
-                f.write(f"{SEGMENT_TERMINATOR}{LINE_BREAK}")
-                
-                # Statement Date Range
-                statement_from = format_date(claim['statement_from_date'])
-                statement_to = format_date(claim['statement_to_date'])
-                f.write(f"DTP{ELEMENT_SEPARATOR}434{ELEMENT_SEPARATOR}RD8{ELEMENT_SEPARATOR}{statement_from}-{statement_to}")
-                f.write(f"{SEGMENT_TERMINATOR}{LINE_BREAK}")
-                
-                # Institutional Claim Code Structure (Diagnoses)
-                # Principal Diagnosis
-                f.write(f"HI{ELEMENT_SEPARATOR}ABK:{claim['principal_diagnosis_code']}")
-                
-                # Secondary Diagnoses if present
-                if claim['secondary_diagnosis_codes']:
-                    secondary_codes = claim['secondary_diagnosis_codes'].split(',')
-                    for i, code in enumerate(secondary_codes):
-                        if i < 8:  # Up to 8 secondary diagnoses in HI segment
-                            f.write(f"{ELEMENT_SEPARATOR}ABF:{code.strip()}")
-                
-                f.write(f"{SEGMENT_TERMINATOR}{LINE_BREAK}")
-                
-                # Service lines
-                for line in claim['service_lines']:
-                    # 2400 Service Line
-                    f.write(f"LX{ELEMENT_SEPARATOR}{line['line_number']}{SEGMENT_TERMINATOR}{LINE_BREAK}")
-                    
-                    # Service Line Information
-                    f.write(f"SV2{ELEMENT_SEPARATOR}{line['revenue_code']}{ELEMENT_SEPARATOR}")
-                    f.write(f"{line['procedure_code_qualifier']}:{line['procedure_code']}")
-                    f.write(f"{ELEMENT_SEPARATOR}{line['charge_amount']}{ELEMENT_SEPARATOR}UN{ELEMENT_SEPARATOR}{line['units']}")
-                    f.write(f"{SEGMENT_TERMINATOR}{LINE_BREAK}")
-                    
-                    # Line Item Service Date
-                    service_date = format_date(line['service_date'])
-                    f.write(f"DTP{ELEMENT_SEPARATOR}472{ELEMENT_SEPARATOR}D8{ELEMENT_SEPARATOR}{service_date}")
-                    f.write(f"{SEGMENT_TERMINATOR}{LINE_BREAK}")
-                
-                # If referring provider NPI exists, add it
-                if claim['referring_provider_npi']:
-                    f.write(f"NM1{ELEMENT_SEPARATOR}DN{ELEMENT_SEPARATOR}1")
-                    f.write(f"{ELEMENT_SEPARATOR}REFERRING{ELEMENT_SEPARATOR}PROVIDER")
-                    f.write(f"{ELEMENT_SEPARATOR}{ELEMENT_SEPARATOR}{ELEMENT_SEPARATOR}{ELEMENT_SEPARATOR}XX")
-                    f.write(f"{ELEMENT_SEPARATOR}{claim['referring_provider_npi']}{SEGMENT_TERMINATOR}{LINE_BREAK}")
-                
-                # If attending provider NPI exists, add it
-                if claim['attending_provider_npi']:
-                    f.write(f"NM1{ELEMENT_SEPARATOR}71{ELEMENT_SEPARATOR}1")
-                    f.write(f"{ELEMENT_SEPARATOR}ATTENDING{ELEMENT_SEPARATOR}PROVIDER")
-                    f.write(f"{ELEMENT_SEPARATOR}{ELEMENT_SEPARATOR}{ELEMENT_SEPARATOR}{ELEMENT_SEPARATOR}XX")
-                    f.write(f"{ELEMENT_SEPARATOR}{claim['attending_provider_npi']}{SEGMENT_TERMINATOR}{LINE_BREAK}")
-                    
-                    # Attending Provider Specialty
-                    f.write(f"PRV{ELEMENT_SEPARATOR}AT{ELEMENT_SEPARATOR}PXC")
-                    f.write(f"{ELEMENT_SEPARATOR}{claim['provider_taxonomy_code']}{SEGMENT_TERMINATOR}{LINE_BREAK}")
-            
-            # SE - Transaction Set Trailer
-            f.write(f"SE{ELEMENT_SEPARATOR}[COUNT]{ELEMENT_SEPARATOR}{st_control_number}{SEGMENT_TERMINATOR}{LINE_BREAK}")
-            
-            # GE - Functional Group Trailer
-            f.write(f"GE{ELEMENT_SEPARATOR}1{ELEMENT_SEPARATOR}{gs_control_number}{SEGMENT_TERMINATOR}{LINE_BREAK}")
-            
-            # IEA - Interchange Control Trailer
-            f.write(f"IEA{ELEMENT_SEPARATOR}1{ELEMENT_SEPARATOR}{isa_control_number}{SEGMENT_TERMINATOR}")
-        
-        # Now go back and replace [COUNT] with actual segment count
-        # This is a simplified approach; in practice, you'd want to count segments during generation
-        with open(file_path, 'r') as f:
-            content = f.read()
-        
-        # Count segments (adjust based on actual format if needed)
-        segment_count = content.count(SEGMENT_TERMINATOR)
-        
-        # Replace placeholder with count
-        content = content.replace(f"SE{ELEMENT_SEPARATOR}[COUNT]", f"SE{ELEMENT_SEPARATOR}{segment_count}")
-        
-        with open(file_path, 'w') as f:
-            f.write(content)
-        
-        print(f"Generated 837I file: {file_path} with {len(batch)} claims")
+        while pending:
+            collect()
     
     return file_paths
 
+def verify_837i_files(file_paths):
+    """Read generated 837I files back and check their envelopes and HL hierarchy
+    
+    Prints each problem found and returns the number of files with problems.
+    """
+    failed = 0
+    for file_path in file_paths:
+        problems = verify_interchange(file_path)
+        if problems:
+            failed += 1
+            print(f"Verification failed for {file_path}:")
+            for problem in problems:
+                print(f"  {problem}")
+    print(f"Verified {len(file_paths)} 837I files, {failed} with problems.")
+    return failed
+
 def validate_subscriber_info(claims):
     """Validate subscriber information based on KY Medicaid requirements"""
     validation_results = []
@@ -496,56 +787,371 @@ def validate_subscriber_info(claims):
     
     return validation_results
 
-def main():
+def open_validation_log(log_format='text', max_bytes=None, compress=False):
+    """Open a streaming validation log in OUTPUT_DIR"""
+    if not os.path.exists(OUTPUT_DIR):
+        os.makedirs(OUTPUT_DIR)
+    
+    extension = 'jsonl' if log_format == 'jsonl' else 'txt'
+    log_file = os.path.join(OUTPUT_DIR, f"validation_log_{datetime.now().strftime('%Y%m%d_%H%M%S')}.{extension}")
+    return ValidationLogWriter(log_file, title="Kentucky Medicaid 837I Validation Log", fmt=log_format,
+                               max_bytes=max_bytes, compress=compress)
+
+def process_claims_streaming(conn, log, workers=None, rules=KY_MEDICAID_RULES, tracker=None, new_only=False,
+                             profile=KY_MEDICAID_PROFILE, stats=None):
+    """Fetch, validate and write claims without holding the whole table in memory
+    
+    Claims come off the database cursor in fetchmany chunks, pass through
+    validation one at a time and are written into the current 837I batch as
+    they arrive. Validation results go straight to log.
+    
+    With a ClaimChangeTracker, only new or changed claims are validated and
+    written, and the tracker is committed once the files are written. With
+    new_only, claims at or below the tracker's watermark are not read.
+    Interchanges are written and sized for profile. stats, if given, gets
+    the 'total' and 'valid' claim counts.
+    """
+    if stats is None:
+        stats = {}
+    stats.update(total=0, valid=0)
+    try:
+        claims = iter_claims(conn, after_claim_id=tracker.watermark if new_only else None)
+        if tracker is not None:
+            claims = tracker.changes(claims, log)
+        valid_claims = iter_valid_claims(claims, log, stats, rules)
+        if tracker is not None:
+            valid_claims = tracker.mark_submitted(valid_claims)
+        output_files = generate_837i_file(valid_claims, workers=workers, profile=profile)
+        if tracker is not None:
+            tracker.commit()
+    finally:
+        log.close(stats)
+    
+    print(f"Validation complete. {stats['valid']} of {stats['total']} claims are valid.")
+    print(f"Validation results: {log.counts[ErrorLevel.ERROR]} errors, {log.counts[ErrorLevel.WARNING]} warnings, "
+          f"{log.counts[ErrorLevel.INFO]} info messages")
+    print(f"Validation log written to {log.paths[0]}" + (f" ({len(log.paths)} parts)" if len(log.paths) > 1 else ""))
+    return output_files
+
+def process_claims_by_payer(conn, log, registry, workers=None, tracker=None, totals=None, new_only=False):
+    """Feed one scan of the claims table to every payer profile in registry
+    
+    Each claim is validated with its payer's rules and added to that payer's
+    ClaimBatcher. A full batch is written straight away, in a process pool
+    shared by all payers when workers > 1, so every trading partner's
+    interchanges are produced concurrently from the same pass over the
+    database. Claims whose payer has no profile are logged as errors.
+    Returns the output files by profile name. totals, if given, gets the
+    'total' and 'valid' claim counts across all payers. With a tracker and
+    new_only, claims at or below the tracker's watermark are not read.
+    """
+    if totals is None:
+        totals = {}
+    now = datetime.now()
+    stats = {profile.name: {'total': 0, 'valid': 0} for profile in registry}
+    batchers = {
+        profile.name: ClaimBatcher(profile.batch_size, profile.max_bytes, profile.max_segments) for profile in registry
+    }
+    output_files = {name: [] for name in batchers}
+    allocators = {}
+    pending = deque()
+    pool = ProcessPoolExecutor(max_workers=workers) if workers and workers > 1 else None
+    
+    def collect():
+        profile, allocator, control_number, future = pending.popleft()
+        file_path = future.result()
+        allocator.record(control_number, file_path)
+        output_files[profile.name].append(file_path)
+    
+    def write_batch(profile, batch):
+        # Profiles with the same sender share one control number sequence
+        allocator = allocators.get(profile.sender_id)
+        if allocator is None:
+            allocator = allocators[profile.sender_id] = ControlNumberAllocator(
+                CONTROL_DB_PATH, sender_id=profile.sender_id
+            )
+        control_number = allocator.next()
+        
+        if pool is None:
+            file_path = write_837i_batch(batch, control_number, now, profile)
+            allocator.record(control_number, file_path)
+            output_files[profile.name].append(file_path)
+            return
+        
+        pending.append((
+            profile, allocator, control_number,
+            pool.submit(write_837i_batch, batch, control_number, now, profile)
+        ))
+        if len(pending) >= workers * 2:
+            collect()
+    
+    unrouted = 0
+    try:
+        for profile in registry:
+            log.extend(profile.rules.advisories())
+        
+        claims = iter_claims(conn, after_claim_id=tracker.watermark if new_only else None)
+        if tracker is not None:
+            claims = tracker.changes(claims, log)
+        
+        for claim in claims:
+            profile = registry.profile_for(claim)
+            if profile is None:
+                unrouted += 1
+                log.append(ValidationError(claim['claim_id'], ErrorLevel.ERROR,
+                                           f"No payer profile for payer {claim.get('payer_id_code')}",
+                                           'payer_id_code'))
+                continue
+            
+            profile_stats = stats[profile.name]
+            profile_stats['total'] += 1
+            claim_errors = profile.rules.validate(claim)
+            if has_errors(claim_errors):
+                log.extend(claim_errors)
+                continue
+            
+            claim_errors.extend(validate_subscriber_info((claim,)))
+            log.extend(claim_errors)
+            profile_stats['valid'] += 1
+            if tracker is not None:
+                tracker.mark(claim)
+            
+            batch = batchers[profile.name].add(claim)
+            if batch:
+                write_batch(profile, batch)
+        
+        for profile in registry:
+            if batchers[profile.name].batch:
+                write_batch(profile, batchers[profile.name].take())
+        while pending:
+            collect()
+        
+        if tracker is not None:
+            tracker.commit()
+    finally:
+        if pool is not None:
+            pool.shutdown()
+        for allocator in allocators.values():
+            allocator.close()
+        totals.update(
+            total=sum(profile_stats['total'] for profile_stats in stats.values()) + unrouted,
+            valid=sum(profile_stats['valid'] for profile_stats in stats.values()),
+        )
+        log.close(totals)
+    
+    for name, profile_stats in stats.items():
+        print(f"{name}: {profile_stats['valid']} of {profile_stats['total']} claims valid, "
+              f"{len(output_files[name])} 837I files")
+    if unrouted:
+        print(f"{unrouted} claims have no payer profile")
+    print(f"Validation results: {log.counts[ErrorLevel.ERROR]} errors, {log.counts[ErrorLevel.WARNING]} warnings, "
+          f"{log.counts[ErrorLevel.INFO]} info messages")
+    print(f"Validation log written to {log.paths[0]}" + (f" ({len(log.paths)} parts)" if len(log.paths) > 1 else ""))
+    return output_files
+
+def process_claims_list(conn, log, stats, report, rules=KY_MEDICAID_RULES, profile=KY_MEDICAID_PROFILE,
+                        workers=None, columnar=False, tracker=None, after_claim_id=None):
+    """Load every claim, then validate and write them, timing each stage in report
+    
+    stats gets the 'total' and 'valid' claim counts. Returns the 837I files
+    written.
+    """
+    try:
+        if columnar and tracker is None:
+            # Validate the claims table column by column, then load only valid claims
+            print("Validating claims...")
+            with report.stage('validate') as stage:
+                stats['total'], invalid_ids, validation_results = validate_claims_columnar(conn, rules)
+                log.extend(validation_results)
+                stage['items'] = stats['total']
+            print("Fetching valid claims data...")
+            with report.stage('fetch') as stage:
+                valid_claims = [claim for claim in iter_claims(conn) if claim['claim_id'] not in invalid_ids]
+                stage['items'] = len(valid_claims)
+        else:
+            # Fetch claims data
+            print("Fetching claims data...")
+            with report.stage('fetch') as stage:
+                claims = fetch_claims_data(conn, after_claim_id)
+                stage['items'] = len(claims)
+            print(f"Retrieved {len(claims)} claims")
+            if tracker is not None:
+                with report.stage('detect_changes') as stage:
+                    stage['items'] = len(claims)
+                    claims = list(tracker.changes(claims, log))
+                print(f"{len(claims)} claims are new or changed")
+            stats['total'] = len(claims)
+            
+            # Validate claims against KY Medicaid requirements, logging results as they are found
+            print("Validating claims...")
+            with report.stage('validate') as stage:
+                valid_claims, _ = validate_claims(claims, rules, validation_results=log)
+                stage['items'] = len(claims)
+        stats['valid'] = len(valid_claims)
+        
+        # Additional validation for subscriber information
+        with report.stage('validate_subscribers') as stage:
+            log.extend(validate_subscriber_info(valid_claims))
+            stage['items'] = len(valid_claims)
+        
+        # Print validation results
+        print(f"Validation complete. {stats['valid']} of {stats['total']} claims are valid.")
+        counts = log.counts
+        print(f"Validation results: {counts[ErrorLevel.ERROR]} errors, {counts[ErrorLevel.WARNING]} warnings, "
+              f"{counts[ErrorLevel.INFO]} info messages")
+        
+        # Generate 837I files
+        print("Generating 837I files...")
+        with report.stage('generate_837i') as stage:
+            stage['items'] = len(valid_claims)
+            if tracker is not None:
+                valid_claims = tracker.mark_submitted(valid_claims)
+            output_files = generate_837i_file(valid_claims, workers=workers, profile=profile)
+            if tracker is not None:
+                tracker.commit()
+    finally:
+        with report.stage('write_log') as stage:
+            log.close(stats)
+            stage['items'] = sum(log.counts.values())
+    
+    print(f"Validation log written to {log.paths[0]}" + (f" ({len(log.paths)} parts)" if len(log.paths) > 1 else ""))
+    return output_files
+
+def print_stage_summary(report):
+    """Print how long each stage of the run took"""
+    print(f"{'Stage':<24}{'Seconds':>10}{'Items/s':>14}")
+    for name, record in report.stages.items():
+        print(f"{name:<24}{record['seconds']:>10.3f}{record['per_second']:>14,.0f}")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Kentucky Medicaid 837I Processor")
+    parser.add_argument('--stream', action='store_true',
+                        help="validate and write claims as they are read instead of loading them all first")
+    parser.add_argument('--workers', type=int, default=None,
+                        help="render 837I batches in this many worker processes")
+    parser.add_argument('--columnar', action='store_true',
+                        help="validate the claims table column by column with pandas (ignored with --stream)")
+    parser.add_argument('--rules', default=None,
+                        help="JSON rule table to validate against instead of the KY Medicaid rules")
+    parser.add_argument('--log-format', choices=LOG_FORMATS, default='text',
+                        help="write the validation log as text or JSON lines")
+    parser.add_argument('--log-max-bytes', type=int, default=None,
+                        help="start a new validation log part once the current one reaches this size")
+    parser.add_argument('--log-gzip', action='store_true',
+                        help="gzip the validation log")
+    parser.add_argument('--explain', action='store_true',
+                        help="print the query plans of the claim loader and warn about full scans")
+    parser.add_argument('--max-claims', type=int, default=None,
+                        help="most claims in one 837I interchange (default 100)")
+    parser.add_argument('--max-bytes', type=int, default=None,
+                        help="cut 837I interchanges at about this many bytes")
+    parser.add_argument('--max-segments', type=int, default=None,
+                        help="cut 837I interchanges at this many segments")
+    parser.add_argument('--payers', default=None,
+                        help="JSON payer profile registry; claims are routed to each payer's profile in one scan "
+                             "(--rules, --stream, --columnar and the --max-* limits are ignored)")
+    parser.add_argument('--verify', action='store_true',
+                        help="read the generated 837I files back and check envelope counts, control numbers "
+                             "and HL links")
+    parser.add_argument('--report', default=None,
+                        help="write a JSON run report with per-stage timings and counters to this path")
+    parser.add_argument('--profile', default=None,
+                        help="profile the run with cProfile, write the stats to this path and list the top "
+                             "functions in the run report")
+    parser.add_argument('--trace-memory', action='store_true',
+                        help="trace Python allocations with tracemalloc and add per-stage peaks to the run report")
+    parser.add_argument('--incremental', action='store_true',
+                        help="only validate and write claims that are new or changed since they were last "
+                             "submitted (--columnar is ignored)")
+    parser.add_argument('--new-only', action='store_true',
+                        help="with --incremental, skip reading claims at or below the last run's highest "
+                             "claim_id; changes to older claims are not picked up")
+    args = parser.parse_args(argv)
+    rules = RuleSet.load(args.rules) if args.rules else KY_MEDICAID_RULES
+    profile = KY_MEDICAID_PROFILE.replace(
+        batch_size=args.max_claims or KY_MEDICAID_PROFILE.batch_size,
+        max_bytes=args.max_bytes,
+        max_segments=args.max_segments,
+    )
+    
+    report = RunReport(profile=bool(args.profile), trace_memory=args.trace_memory)
+    report.start()
+    
     print("Kentucky Medicaid 837I Processor")
     print("-" * 50)
     
     # Connect to database
     print("Connecting to database...")
-    conn = connect_to_db()
-    
-    # Fetch claims data
-    print("Fetching claims data...")
-    claims = fetch_claims_data(conn)
-    print(f"Retrieved {len(claims)} claims")
-    
-    # Validate claims against KY Medicaid requirements
-    print("Validating claims...")
-    valid_claims, validation_results = validate_claims(claims)
-    
-    # Additional validation for subscriber information
-    subscriber_validation = validate_subscriber_info(valid_claims)
-    validation_results.extend(subscriber_validation)
-    
-    # Print validation results
-    print(f"Validation complete. {len(valid_claims)} of {len(claims)} claims are valid.")
-    error_count = sum(1 for e in validation_results if e.level == ErrorLevel.ERROR)
-    warning_count = sum(1 for e in validation_results if e.level == ErrorLevel.WARNING)
-    info_count = sum(1 for e in validation_results if e.level == ErrorLevel.INFO)
-    print(f"Validation results: {error_count} errors, {warning_count} warnings, {info_count} info messages")
-    
-    # Generate 837I files
-    print("Generating 837I files...")
-    output_files = generate_837i_file(valid_claims)
-    
-    # Write validation results to log file
-    log_file = os.path.join(OUTPUT_DIR, f"validation_log_{datetime.now().strftime('%Y%m%d_%H%M%S')}.txt")
-    with open(log_file, 'w') as f:
-        f.write("Kentucky Medicaid 837I Validation Log\n")
-        f.write("-" * 80 + "\n")
-        f.write(f"Date/Time: {datetime.now()}\n")
-        f.write(f"Total Claims: {len(claims)}\n")
-        f.write(f"Valid Claims: {len(valid_claims)}\n")
-        f.write("-" * 80 + "\n\n")
-        
-        for result in validation_results:
-            f.write(f"{result}\n")
+    with report.stage('connect'):
+        conn = connect_to_db()
+    
+    if args.explain:
+        for name, (plan, warnings) in explain_loader_queries(conn).items():
+            print(f"Query plan for {name}:")
+            for detail in plan:
+                print(f"  {detail}")
+            for warning in warnings:
+                print(f"  WARNING: full scan or sort: {warning}")
+    
+    tracker = None
+    if args.incremental or args.new_only:
+        tracker = ClaimChangeTracker(STATE_DB_PATH)
+        print(f"Incremental run, last claim_id processed: {tracker.watermark}")
+    after_claim_id = tracker.watermark if args.new_only else None
+    
+    log = open_validation_log(args.log_format, args.log_max_bytes, args.log_gzip)
+    stats = {'total': 0, 'valid': 0}
+    
+    if args.payers:
+        registry = PayerRegistry.load(args.payers)
+        print(f"Routing claims to {len(registry)} payer profiles...")
+        with report.stage('process') as stage:
+            output_files = [
+                file_path
+                for file_paths in process_claims_by_payer(conn, log, registry, args.workers, tracker, stats,
+                                                          args.new_only).values()
+                for file_path in file_paths
+            ]
+            stage['items'] = stats['total']
+    elif args.stream:
+        print("Streaming claims through validation and 837I generation...")
+        with report.stage('process') as stage:
+            output_files = process_claims_streaming(conn, log, workers=args.workers, rules=rules, tracker=tracker,
+                                                    new_only=args.new_only, profile=profile, stats=stats)
+            stage['items'] = stats['total']
+    else:
+        output_files = process_claims_list(conn, log, stats, report, rules=rules, profile=profile,
+                                           workers=args.workers, columnar=args.columnar, tracker=tracker,
+                                           after_claim_id=after_claim_id)
     
-    print(f"Validation log written to {log_file}")
     print(f"Processing complete. Generated {len(output_files)} 837I files in {OUTPUT_DIR}.")
+    report.count('claims_total', stats['total'])
+    report.count('claims_valid', stats['valid'])
+    report.count('output_files', len(output_files))
+    for level, count in log.counts.items():
+        report.count(f"validation_{level.lower()}", count)
     
+    if tracker is not None:
+        tracker.close()
     conn.close()
-    return 0
+    
+    failed = 0
+    if args.verify:
+        with report.stage('verify') as stage:
+            failed = verify_837i_files(output_files)
+            stage['items'] = len(output_files)
+        report.count('verify_failed_files', failed)
+    
+    report.stop()
+    if args.profile:
+        report.dump_profile(args.profile)
+        print(f"Profile written to {args.profile}")
+    if args.report:
+        report.write(args.report)
+        print(f"Run report written to {args.report}")
+    print_stage_summary(report)
+    
+    return 1 if failed else 0
 
 if __name__ == "__main__":
     sys.exit(main()) 
\ No newline at end of file
@@ -0,0 +1,100 @@
+import sqlite3
+from datetime import datetime
+
+# ISA13 and GS06 are at most nine digits
+MAX_CONTROL_NUMBER = 999999999
+
+class ControlNumberAllocator:
+    """Hand out X12 control numbers from a persistent counter in SQLite
+
+    Numbers are reserved from the counter in blocks of block_size with one
+    short write transaction, then issued from memory, so a run only touches
+    the database once per block. Separate processes sharing the same
+    database file always get disjoint blocks. Numbers left over in a block
+    when the allocator is closed are skipped, never reissued.
+
+    Every issued number can be recorded against the file it was written to
+    in the control_number_audit table. 837I file names end with their ISA13
+    control number, so each file maps to exactly one number.
+    """
+    def __init__(self, path, sender_id, block_size=100):
+        self.path = path
+        self.sender_id = sender_id
+        self.block_size = block_size
+        self.block = iter(())
+        self.conn = sqlite3.connect(path, timeout=30, isolation_level=None)
+        self.conn.executescript('''
+        CREATE TABLE IF NOT EXISTS control_counters (
+            sender_id TEXT PRIMARY KEY,
+            next_value INTEGER NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS control_number_audit (
+            sender_id TEXT NOT NULL,
+            control_number INTEGER NOT NULL,
+            file_path TEXT NOT NULL,
+            issued_at TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_control_number_audit
+            ON control_number_audit (sender_id, control_number);
+        CREATE INDEX IF NOT EXISTS idx_control_number_audit_file
+            ON control_number_audit (file_path);
+        ''')
+
+    def reserve(self, count):
+        """Reserve count consecutive control numbers and return them as a range"""
+        self.conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = self.conn.execute(
+                'SELECT next_value FROM control_counters WHERE sender_id = ?', (self.sender_id,)
+            ).fetchone()
+            start = row[0] if row else 1
+            # Wrap around rather than overflow the nine-digit field
+            if start + count - 1 > MAX_CONTROL_NUMBER:
+                start = 1
+            self.conn.execute(
+                'INSERT OR REPLACE INTO control_counters (sender_id, next_value) VALUES (?, ?)',
+                (self.sender_id, start + count)
+            )
+            self.conn.execute('COMMIT')
+        except Exception:
+            self.conn.execute('ROLLBACK')
+            raise
+        return range(start, start + count)
+
+    def next(self):
+        """Issue the next control number, reserving a new block when needed"""
+        control_number = next(self.block, None)
+        if control_number is None:
+            self.block = iter(self.reserve(self.block_size))
+            control_number = next(self.block)
+        return control_number
+
+    def record(self, control_number, file_path):
+        """Record which output file a control number was used for"""
+        self.conn.execute(
+            'INSERT INTO control_number_audit (sender_id, control_number, file_path, issued_at) VALUES (?, ?, ?, ?)',
+            (self.sender_id, control_number, str(file_path), datetime.now().isoformat())
+        )
+
+    def lookup(self, control_number):
+        """Return the (file_path, issued_at) rows recorded for a control number"""
+        return self.conn.execute(
+            'SELECT file_path, issued_at FROM control_number_audit WHERE sender_id = ? AND control_number = ?',
+            (self.sender_id, control_number)
+        ).fetchall()
+
+    def lookup_file(self, file_path):
+        """Return the (sender_id, control_number, issued_at) rows recorded for an output file"""
+        return self.conn.execute(
+            'SELECT sender_id, control_number, issued_at FROM control_number_audit WHERE file_path = ?',
+            (str(file_path),)
+        ).fetchall()
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,108 @@
+import copy
+import json
+import os
+
+from validationRules import RuleSet
+
+class PayerProfile:
+    """Everything that ties an 837I run to one trading partner
+
+    Covers the interchange sender and receiver IDs, the submitter and payer
+    names written in the 1000A, 1000B and 2010BB loops, the validation rules,
+    the size limits of one interchange and the prefix of its file names.
+    payer_id_codes lists the payers.payer_id_code values routed to this
+    profile.
+
+    An interchange holds at most batch_size claims and, when they are set,
+    roughly max_bytes bytes and at most max_segments segments.
+    """
+    def __init__(self, name, sender_id, receiver_id, rules, payer_id_codes=(), receiver_name=None,
+                 payer_name=None, payer_id=None, submitter_id=None, contact_name='SUBMITTER CONTACT',
+                 contact_phone='8005551234', batch_size=100, max_bytes=None, max_segments=None,
+                 file_prefix=None):
+        self.name = name
+        self.sender_id = sender_id
+        self.receiver_id = receiver_id
+        self.rules = rules
+        self.payer_id_codes = tuple(payer_id_codes)
+        self.receiver_name = receiver_name or receiver_id
+        self.payer_name = payer_name or self.receiver_name
+        self.payer_id = payer_id or receiver_id
+        self.submitter_id = submitter_id or sender_id
+        self.contact_name = contact_name
+        self.contact_phone = contact_phone
+        self.batch_size = batch_size
+        self.max_bytes = max_bytes
+        self.max_segments = max_segments
+        self.file_prefix = file_prefix or f"837I_{receiver_id}"
+
+    def replace(self, **changes):
+        """Return a copy of the profile with some settings changed"""
+        profile = copy.copy(self)
+        for name, value in changes.items():
+            if not hasattr(profile, name):
+                raise AttributeError(f"PayerProfile has no setting {name}")
+            setattr(profile, name, value)
+        return profile
+
+    @classmethod
+    def from_dict(cls, data, base_dir='.'):
+        """Build a profile from a dict, with rules inline or as a path to a JSON rule table"""
+        data = dict(data)
+        rules = data.pop('rules')
+        if isinstance(rules, str):
+            rules = RuleSet.load(os.path.join(base_dir, rules))
+        else:
+            rules = RuleSet.from_dict(rules)
+        return cls(rules=rules, **data)
+
+class PayerRegistry:
+    """Look up the payer profile for each claim by its payer_id_code
+
+    Claims whose payer has no profile of its own go to the default profile,
+    if there is one.
+    """
+    def __init__(self, profiles=(), default=None):
+        self.profiles = {}
+        self.by_payer = {}
+        self.default = None
+        for profile in profiles:
+            self.register(profile)
+        if default is not None:
+            self.default = self.profiles[default] if isinstance(default, str) else default
+
+    def register(self, profile):
+        if profile.name in self.profiles:
+            raise ValueError(f"Duplicate payer profile: {profile.name}")
+        for other in self.profiles.values():
+            if other.file_prefix == profile.file_prefix:
+                raise ValueError(f"Payer profiles {other.name} and {profile.name} share file prefix {profile.file_prefix}")
+        for code in profile.payer_id_codes:
+            if code in self.by_payer:
+                raise ValueError(f"Payer {code} is in both {self.by_payer[code].name} and {profile.name}")
+            self.by_payer[code] = profile
+        self.profiles[profile.name] = profile
+
+    def profile_for(self, claim):
+        """Return the profile for a claim, or None if no profile takes its payer"""
+        return self.by_payer.get(claim.get('payer_id_code'), self.default)
+
+    def __iter__(self):
+        return iter(self.profiles.values())
+
+    def __len__(self):
+        return len(self.profiles)
+
+    @classmethod
+    def load(cls, path):
+        """Load profiles from a JSON file with a profiles list and an optional default name
+
+        Rule table paths inside the file are relative to the file itself.
+        """
+        with open(path) as f:
+            data = json.load(f)
+        base_dir = os.path.dirname(os.path.abspath(path))
+        return cls(
+            [PayerProfile.from_dict(profile, base_dir) for profile in data['profiles']],
+            data.get('default')
+        )
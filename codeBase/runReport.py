@@ -0,0 +1,132 @@
+import cProfile
+import json
+import pstats
+import sys
+import time
+import tracemalloc
+from contextlib import contextmanager
+from datetime import datetime
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# Functions and allocation sites listed in the report
+REPORT_TOP_N = 25
+
+def peak_rss_mb():
+    """High-water mark of this process's resident set size, in MB"""
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and kilobytes elsewhere
+    return rss / (1024 * 1024) if sys.platform == 'darwin' else rss / 1024
+
+class RunReport:
+    """Stage timings, counters and optional profiles for one processor run
+
+    Each stage records wall and CPU seconds, the items it handled, items per
+    second and the process's peak RSS when it ended. With trace_memory, the
+    peak traced Python allocation inside each stage is recorded as well and
+    the largest allocation sites are listed in the report; with profile,
+    the whole run is profiled with cProfile. as_dict() and write() give the
+    report as JSON so runs can be compared over time.
+    """
+    def __init__(self, profile=False, trace_memory=False):
+        self.started = datetime.now()
+        self.finished = None
+        self.stages = {}
+        self.counters = {}
+        self.profiler = cProfile.Profile() if profile else None
+        self.trace_memory = trace_memory
+        self.memory_top = None
+        self._start = time.perf_counter()
+        self._seconds = None
+
+    def start(self):
+        if self.trace_memory:
+            tracemalloc.start()
+        if self.profiler is not None:
+            self.profiler.enable()
+
+    def stop(self):
+        if self.profiler is not None:
+            self.profiler.disable()
+        if self.trace_memory and tracemalloc.is_tracing():
+            snapshot = tracemalloc.take_snapshot()
+            self.memory_top = [
+                {'location': str(stat.traceback), 'size_mb': stat.size / (1024 * 1024), 'count': stat.count}
+                for stat in snapshot.statistics('lineno')[:REPORT_TOP_N]
+            ]
+            tracemalloc.stop()
+        self.finished = datetime.now()
+        self._seconds = time.perf_counter() - self._start
+
+    @contextmanager
+    def stage(self, name):
+        """Time a stage; set 'items' on the yielded record to get a throughput
+
+        A stage entered more than once adds to its earlier totals.
+        """
+        record = {'items': 0}
+        if self.trace_memory and tracemalloc.is_tracing():
+            tracemalloc.reset_peak()
+        start = time.perf_counter()
+        cpu_start = time.process_time()
+        try:
+            yield record
+        finally:
+            seconds = time.perf_counter() - start
+            cpu_seconds = time.process_time() - cpu_start
+            previous = self.stages.get(name)
+            if previous is not None:
+                seconds += previous['seconds']
+                cpu_seconds += previous['cpu_seconds']
+                record['items'] += previous['items']
+            record['seconds'] = seconds
+            record['cpu_seconds'] = cpu_seconds
+            record['per_second'] = record['items'] / seconds if seconds else 0.0
+            record['peak_rss_mb'] = peak_rss_mb()
+            if self.trace_memory and tracemalloc.is_tracing():
+                record['peak_traced_mb'] = tracemalloc.get_traced_memory()[1] / (1024 * 1024)
+            self.stages[name] = record
+
+    def count(self, name, value=1):
+        """Add value to a named counter"""
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def profile_top(self):
+        """The most expensive functions by cumulative time, if the run was profiled"""
+        if self.profiler is None:
+            return None
+        stats = pstats.Stats(self.profiler)
+        rows = sorted(stats.stats.items(), key=lambda item: item[1][3], reverse=True)[:REPORT_TOP_N]
+        return [
+            {
+                'function': f"{filename}:{line}({function})",
+                'calls': calls,
+                'seconds': total_time,
+                'cumulative_seconds': cumulative_time,
+            }
+            for (filename, line, function), (_, calls, total_time, cumulative_time, _) in rows
+        ]
+
+    def as_dict(self):
+        return {
+            'started': self.started.isoformat(),
+            'finished': self.finished.isoformat() if self.finished else None,
+            'seconds': self._seconds,
+            'stages': self.stages,
+            'counters': self.counters,
+            'profile': self.profile_top(),
+            'memory': self.memory_top,
+        }
+
+    def write(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.as_dict(), f, indent=2)
+
+    def dump_profile(self, path):
+        """Write the raw cProfile stats, readable with pstats or snakeviz"""
+        self.profiler.dump_stats(path)
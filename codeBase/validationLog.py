@@ -0,0 +1,114 @@
+import gzip
+import json
+import os
+import time
+from datetime import datetime
+
+from validationRules import ErrorLevel
+
+LOG_FORMATS = ('text', 'jsonl')
+
+class ValidationLogWriter:
+    """Write validation results to a log file as they are produced
+
+    Results go through a large write buffer that is flushed at least every
+    flush_interval seconds, so the log can be tailed while a batch runs and
+    holds everything up to a crash. fmt is 'text' for the classic
+    one-result-per-line log or 'jsonl' for one JSON object per line.
+
+    With max_bytes set, the log rotates to a new numbered part
+    (validation_log_X.1.txt, validation_log_X.2.txt, ...) once the current
+    part reaches that size. With compress, every part is gzipped and max_bytes
+    applies to the uncompressed size. Totals are written to the last part
+    by close().
+    """
+    def __init__(self, path, title="Validation Log", fmt='text', max_bytes=None, compress=False,
+                 buffer_size=1 << 20, flush_interval=1.0):
+        if fmt not in LOG_FORMATS:
+            raise ValueError(f"Unknown log format: {fmt}")
+        self.base_path = path
+        self.title = title
+        self.fmt = fmt
+        self.max_bytes = max_bytes
+        self.compress = compress
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+        self.counts = {ErrorLevel.ERROR: 0, ErrorLevel.WARNING: 0, ErrorLevel.INFO: 0}
+        self.paths = []
+        self.file = None
+        self._open_part()
+
+    @property
+    def path(self):
+        """Path of the part currently being written"""
+        return self.paths[-1]
+
+    def _part_path(self, part):
+        path = self.base_path
+        if part:
+            stem, ext = os.path.splitext(path)
+            path = f"{stem}.{part}{ext}"
+        if self.compress:
+            path += '.gz'
+        return path
+
+    def _open_part(self):
+        path = self._part_path(len(self.paths))
+        if self.compress:
+            self.file = gzip.open(path, 'wt', compresslevel=6)
+        else:
+            self.file = open(path, 'w', buffering=self.buffer_size)
+        self.paths.append(path)
+        self.part_bytes = 0
+        self.last_flush = time.monotonic()
+
+        if self.fmt == 'text':
+            self._write(f"{self.title}\n" + "-" * 80 + "\n" + f"Date/Time: {datetime.now()}\n" + "-" * 80 + "\n\n")
+
+    def _write(self, text):
+        self.file.write(text)
+        self.part_bytes += len(text)
+
+    def _format(self, result):
+        if self.fmt == 'text':
+            return f"{result}\n"
+        return json.dumps({
+            'type': 'result',
+            'timestamp': result.timestamp.isoformat(),
+            'level': result.level,
+            'claim_id': result.claim_id,
+            'field': result.field,
+            'message': result.message,
+        }) + "\n"
+
+    def append(self, result):
+        self.extend((result,))
+
+    def extend(self, results):
+        counts = self.counts
+        for result in results:
+            counts[result.level] += 1
+            self._write(self._format(result))
+            if self.max_bytes and self.part_bytes >= self.max_bytes:
+                self.file.close()
+                self._open_part()
+
+        if time.monotonic() - self.last_flush >= self.flush_interval:
+            self.file.flush()
+            self.last_flush = time.monotonic()
+
+    def close(self, stats):
+        """Write the claim totals and counts per level, then close the log"""
+        if self.fmt == 'text':
+            self._write("\n" + "-" * 80 + "\n")
+            self._write(f"Total Claims: {stats['total']}\n")
+            self._write(f"Valid Claims: {stats['valid']}\n")
+        else:
+            self._write(json.dumps({
+                'type': 'summary',
+                'timestamp': datetime.now().isoformat(),
+                'total_claims': stats['total'],
+                'valid_claims': stats['valid'],
+                'counts': self.counts,
+            }) + "\n")
+        self.file.close()
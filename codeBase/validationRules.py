@@ -0,0 +1,222 @@
+import json
+import sys
+import time
+from datetime import datetime
+from string import Formatter
+
+# Validation error levels
+class ErrorLevel:
+    INFO = 'INFO'
+    WARNING = 'WARNING'
+    ERROR = 'ERROR'
+
+class MessageTemplate:
+    """A validation message shared by every result of one rule
+
+    fields lists the names used in the template, so a result only needs to
+    keep a small tuple of parameters and the text is formatted when read.
+    """
+    __slots__ = ('text', 'fields')
+
+    def __init__(self, text):
+        self.text = sys.intern(text)
+        self.fields = tuple(dict.fromkeys(name for _, name, _, _ in Formatter().parse(text) if name))
+
+    def params(self, record, value):
+        """Pick this template's parameters out of a claim or service line"""
+        return tuple(value if name == 'value' else record.get(name) for name in self.fields)
+
+    def render(self, params):
+        return self.text.format_map(dict(zip(self.fields, params)))
+
+class ValidationError:
+    """A single validation result
+
+    Results are slotted, keep a float timestamp and, for rule failures, a
+    shared MessageTemplate with a tuple of parameters instead of their own
+    formatted message, so large runs can hold millions of them.
+    """
+    __slots__ = ('claim_id', 'level', 'field', 'created', '_message', '_params')
+
+    def __init__(self, claim_id, level, message, field=None, params=None):
+        self.claim_id = claim_id
+        self.level = level
+        self.field = field
+        self.created = time.time()
+        self._message = message
+        self._params = params
+
+    @property
+    def message(self):
+        if self._params is None:
+            return self._message
+        return self._message.render(self._params)
+
+    @property
+    def timestamp(self):
+        return datetime.fromtimestamp(self.created)
+
+    def __str__(self):
+        # Run-level advisories are not tied to a single claim
+        subject = f"Claim {self.claim_id}" if self.claim_id is not None else "All claims"
+        return f"{self.timestamp} - [{self.level}] {subject}: {self.message}" + \
+               (f" (Field: {self.field})" if self.field else "")
+
+class ValidationResults:
+    """List-like store of validation results with running per-level counts
+
+    counts is kept up to date as results are added, so reporting totals does
+    not need another pass over the results.
+    """
+    def __init__(self, results=()):
+        self.results = []
+        self.counts = {ErrorLevel.ERROR: 0, ErrorLevel.WARNING: 0, ErrorLevel.INFO: 0}
+        self.extend(results)
+
+    def append(self, result):
+        self.counts[result.level] += 1
+        self.results.append(result)
+
+    def extend(self, results):
+        counts = self.counts
+        for result in results:
+            counts[result.level] += 1
+            self.results.append(result)
+
+    def __iter__(self):
+        return iter(self.results)
+
+    def __len__(self):
+        return len(self.results)
+
+    def __getitem__(self, index):
+        return self.results[index]
+
+class RuleSet:
+    """Payer validation rules compiled from a declarative rule table
+
+    Each rule names a claim or service line field, the values the payer
+    accepts, a level and a message template. Templates are formatted with
+    the offending value as {value} and the record's own fields, for example
+    {line_number} on service line rules. The table is compiled once into
+    tuples of (field, allowed values, level, MessageTemplate), so checking
+    a claim is a membership test per rule, and a failure only records the
+    template's parameters.
+
+    Advisories are constant notices that apply to every claim. They are
+    reported once per run by advisories() rather than once per claim.
+    """
+    def __init__(self, name, rules, advisories=()):
+        self.name = name
+        self.claim_checks = []
+        self.line_checks = []
+        for rule in rules:
+            check = (
+                rule['field'], frozenset(rule['allowed']), rule.get('level', ErrorLevel.ERROR),
+                MessageTemplate(rule['message'])
+            )
+            if rule.get('scope', 'claim') == 'service_line':
+                self.line_checks.append(check)
+            else:
+                self.claim_checks.append(check)
+        self.claim_checks = tuple(self.claim_checks)
+        self.line_checks = tuple(self.line_checks)
+        self.advisory_rules = tuple(
+            (advisory['field'], advisory.get('level', ErrorLevel.INFO), sys.intern(advisory['message']))
+            for advisory in advisories
+        )
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data['name'], data.get('rules', []), data.get('advisories', []))
+
+    @classmethod
+    def load(cls, path):
+        """Load a rule table from a JSON file with name, rules and advisories keys"""
+        with open(path) as f:
+            return cls.from_dict(json.load(f))
+
+    def validate(self, claim):
+        """Return the validation errors for a single claim"""
+        claim_errors = []
+        claim_id = claim['claim_id']
+
+        for field, allowed, level, message in self.claim_checks:
+            value = claim.get(field)
+            if value not in allowed:
+                claim_errors.append(ValidationError(claim_id, level, message, field, message.params(claim, value)))
+
+        if self.line_checks:
+            for line in claim['service_lines']:
+                for field, allowed, level, message in self.line_checks:
+                    value = line.get(field)
+                    if value not in allowed:
+                        claim_errors.append(ValidationError(claim_id, level, message, field, message.params(line, value)))
+
+        return claim_errors
+
+    def columns(self):
+        """Return the claim and service line fields the compiled rules read
+
+        This covers the checked fields and any fields used in message
+        templates, plus claim_id (and line claim_id) for lining rows up.
+        """
+        def fields(checks):
+            needed = {'claim_id'}
+            for field, _, _, message in checks:
+                needed.add(field)
+                needed.update(name for name in message.fields if name != 'value')
+            return sorted(needed)
+
+        return fields(self.claim_checks), fields(self.line_checks) if self.line_checks else []
+
+    def validate_columns(self, claim_columns, line_columns=None):
+        """Check claims held as columns, computing each rule as a boolean mask
+
+        claim_columns maps each field from columns() to a sequence with one
+        entry per claim. line_columns does the same for service lines, which
+        must be grouped by claim in line order; lines whose claim_id is not
+        in claim_columns are ignored. Returns a boolean array flagging
+        claims with ERROR level results, and the validation errors in the
+        same order validate() would produce them claim by claim. Requires
+        numpy and pandas.
+        """
+        import numpy as np
+        import pandas as pd
+
+        claim_ids = claim_columns['claim_id']
+        invalid = np.zeros(len(claim_ids), dtype=bool)
+        keyed_errors = []
+
+        def failures(columns, checks):
+            for rule_num, (field, allowed, level, message) in enumerate(checks):
+                values = pd.Series(columns[field], dtype=object)
+                for pos in np.flatnonzero(~values.isin(list(allowed)).to_numpy()):
+                    params = tuple(
+                        values.iat[pos] if name == 'value' else columns[name][pos] for name in message.fields
+                    )
+                    yield rule_num, pos, level, field, message, params
+
+        for rule_num, pos, level, field, message, params in failures(claim_columns, self.claim_checks):
+            if level == ErrorLevel.ERROR:
+                invalid[pos] = True
+            keyed_errors.append(((pos, 0, 0, rule_num), ValidationError(claim_ids[pos], level, message, field, params)))
+
+        if self.line_checks and line_columns is not None:
+            line_claim = pd.Index(claim_ids).get_indexer(line_columns['claim_id'])
+            for rule_num, pos, level, field, message, params in failures(line_columns, self.line_checks):
+                claim_pos = line_claim[pos]
+                if claim_pos < 0:
+                    continue
+                if level == ErrorLevel.ERROR:
+                    invalid[claim_pos] = True
+                keyed_errors.append(
+                    ((claim_pos, 1, pos, rule_num), ValidationError(claim_ids[claim_pos], level, message, field, params))
+                )
+
+        keyed_errors.sort(key=lambda keyed: keyed[0])
+        return invalid, [error for _, error in keyed_errors]
+
+    def advisories(self):
+        """Return the run-level advisories as validation results"""
+        return [ValidationError(None, level, message, field) for field, level, message in self.advisory_rules]
@@ -0,0 +1,169 @@
+import mmap
+import os
+
+# ISA is fixed width in the standard, but the delimiters are found by
+# position in its elements so a slightly longer ISA (e.g. an eight-digit
+# ISA09 date) is still read correctly
+ISA_ELEMENT_COUNT = 16
+ISA_MAX_LENGTH = 128
+
+class X12Delimiters:
+    """The element, sub-element and segment delimiters declared by an ISA segment"""
+    __slots__ = ('element', 'sub_element', 'segment')
+
+    def __init__(self, element, sub_element, segment):
+        self.element = element
+        self.sub_element = sub_element
+        self.segment = segment
+
+    @classmethod
+    def from_isa(cls, data):
+        """Read the delimiters from the start of an interchange
+
+        The element separator follows the ISA tag, ISA16 is the sub-element
+        separator and the character after it terminates the segment.
+        """
+        if data[:3] != b'ISA':
+            raise ValueError("Interchange does not start with an ISA segment")
+        element = data[3:4]
+        pos = 3
+        for _ in range(ISA_ELEMENT_COUNT - 1):
+            pos = data.find(element, pos + 1)
+            if pos < 0:
+                raise ValueError("ISA segment is incomplete")
+        # pos is now the separator before ISA16
+        if len(data) < pos + 3:
+            raise ValueError("ISA segment is incomplete")
+        return cls(element, data[pos + 1:pos + 2], data[pos + 2:pos + 3])
+
+def iter_segments(path):
+    """Yield the segments of an X12 file as lists of element strings
+
+    The file is memory-mapped and split on the delimiters its ISA segment
+    declares, one segment at a time, so files of any size are read in a
+    single pass without loading them. Line breaks between segments are
+    ignored.
+    """
+    with open(path, 'rb') as f:
+        if not os.fstat(f.fileno()).st_size:
+            raise ValueError("Interchange is empty")
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            delimiters = X12Delimiters.from_isa(data[:ISA_MAX_LENGTH])
+            element = delimiters.element.decode('latin-1')
+            terminator = delimiters.segment
+            pos = 0
+            size = len(data)
+            while pos < size:
+                end = data.find(terminator, pos)
+                if end < 0:
+                    end = size
+                segment = data[pos:end].strip()
+                pos = end + 1
+                if segment:
+                    yield segment.decode('latin-1').split(element)
+
+def _element(segment, index):
+    return segment[index] if len(segment) > index else ''
+
+def verify_interchange(path):
+    """Check the envelopes and hierarchy of an X12 837 interchange
+
+    Verifies that ISA/IEA, GS/GE and ST/SE control numbers match, that
+    IEA01, GE01 and SE01 hold the right counts, and that every HL segment
+    is numbered in sequence, points at an earlier HL in the same transaction
+    set and declares children (HL04) only when it has them. Returns a list
+    of problems, empty when the interchange is sound.
+    """
+    problems = []
+    isa = gs = st = None
+    group_count = transaction_count = segment_count = 0
+    hl_parents = {}
+    hl_has_child_flag = {}
+    hl_children = set()
+    segment_number = 0
+
+    def check_hierarchy():
+        for hl_id, declared in hl_has_child_flag.items():
+            has_children = hl_id in hl_children
+            if declared != has_children:
+                problems.append(f"ST {st[2]}: HL {hl_id} HL04 says {'1' if declared else '0'} "
+                                f"but it has {'children' if has_children else 'no children'}")
+
+    try:
+        for segment in iter_segments(path):
+            segment_number += 1
+            tag = segment[0]
+            if st is not None:
+                segment_count += 1
+
+            if tag == 'ISA':
+                if isa is not None:
+                    problems.append(f"Segment {segment_number}: ISA inside interchange {isa[13]}")
+                isa = segment
+                group_count = 0
+            elif tag == 'GS':
+                if gs is not None:
+                    problems.append(f"Segment {segment_number}: GS {_element(segment, 6)} before GE of group {gs[6]}")
+                gs = segment
+                group_count += 1
+                transaction_count = 0
+            elif tag == 'ST':
+                if st is not None:
+                    problems.append(f"Segment {segment_number}: ST {_element(segment, 2)} before SE of {st[2]}")
+                st = segment
+                segment_count = 1
+                transaction_count += 1
+                hl_parents.clear()
+                hl_has_child_flag.clear()
+                hl_children.clear()
+            elif tag == 'HL':
+                hl_id, parent_id, child_code = _element(segment, 1), _element(segment, 2), _element(segment, 4)
+                if st is None:
+                    problems.append(f"Segment {segment_number}: HL {hl_id} outside a transaction set")
+                    continue
+                if hl_id != str(len(hl_parents) + 1):
+                    problems.append(f"ST {st[2]}: HL {hl_id} out of sequence, expected {len(hl_parents) + 1}")
+                if parent_id:
+                    if parent_id not in hl_parents:
+                        problems.append(f"ST {st[2]}: HL {hl_id} parent {parent_id} does not precede it")
+                    hl_children.add(parent_id)
+                hl_parents[hl_id] = parent_id
+                hl_has_child_flag[hl_id] = child_code == '1'
+            elif tag == 'SE':
+                if st is None:
+                    problems.append(f"Segment {segment_number}: SE without ST")
+                    continue
+                if _element(segment, 1) != str(segment_count):
+                    problems.append(f"ST {st[2]}: SE01 is {_element(segment, 1)}, counted {segment_count} segments")
+                if _element(segment, 2) != st[2]:
+                    problems.append(f"ST {st[2]}: SE02 {_element(segment, 2)} does not match ST02")
+                check_hierarchy()
+                st = None
+            elif tag == 'GE':
+                if gs is None:
+                    problems.append(f"Segment {segment_number}: GE without GS")
+                    continue
+                if _element(segment, 1) != str(transaction_count):
+                    problems.append(f"GS {gs[6]}: GE01 is {_element(segment, 1)}, "
+                                    f"counted {transaction_count} transaction sets")
+                if _element(segment, 2) != gs[6]:
+                    problems.append(f"GS {gs[6]}: GE02 {_element(segment, 2)} does not match GS06")
+                gs = None
+            elif tag == 'IEA':
+                if isa is None:
+                    problems.append(f"Segment {segment_number}: IEA without ISA")
+                    continue
+                if _element(segment, 1) != str(group_count):
+                    problems.append(f"ISA {isa[13]}: IEA01 is {_element(segment, 1)}, counted {group_count} groups")
+                if _element(segment, 2) != isa[13]:
+                    problems.append(f"ISA {isa[13]}: IEA02 {_element(segment, 2)} does not match ISA13")
+                isa = None
+            elif st is None:
+                problems.append(f"Segment {segment_number}: {tag} outside a transaction set")
+    except ValueError as e:
+        return [str(e)]
+
+    for name, segment, trailer, index in (('ST', st, 'SE', 2), ('GS', gs, 'GE', 6), ('ISA', isa, 'IEA', 13)):
+        if segment is not None:
+            problems.append(f"{name} {_element(segment, index)}: missing {trailer} trailer")
+    return problems
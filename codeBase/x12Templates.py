@@ -0,0 +1,78 @@
+from string import Formatter
+
+class Segment:
+    """One X12 segment in a loop template
+
+    spec is the segment written with '*' between elements, ':' between
+    components and {field} for values, e.g. 'N4*{city}*{state}*{zip_code}'.
+    With when, the segment is only written if that field is truthy; with
+    unless, only if it is falsy.
+    """
+    __slots__ = ('spec', 'when', 'unless')
+
+    def __init__(self, spec, when=None, unless=None):
+        self.spec = spec
+        self.when = when
+        self.unless = unless
+
+class LoopTemplate:
+    """A loop of X12 segments compiled once into format strings
+
+    Runs of segments that share the same condition are joined into a single
+    format string, so rendering a loop is a few format_map calls rather than
+    one call per segment. Values are formatted as str() would, so None and
+    floats come out exactly as they would from a hand-written f-string.
+
+    Rendered text has segment terminators between segments but not after
+    the last one, matching how SegmentWriter joins segments. The separators
+    default to the usual X12 '*', ':' and '~', so templates written for
+    837I can be reused for 837P or 837D loops.
+    """
+    def __init__(self, name, segments, element_separator='*', sub_element_separator=':',
+                 segment_terminator='~', line_break='\n'):
+        self.name = name
+        self.separator = segment_terminator + line_break
+        self.groups = []
+        for segment in segments:
+            spec = self._compile(segment.spec, element_separator, sub_element_separator)
+            condition = (segment.when, segment.unless)
+            if self.groups and self.groups[-1][0] == condition:
+                _, specs = self.groups[-1]
+                specs.append(spec)
+            else:
+                self.groups.append((condition, [spec]))
+        self.groups = tuple(
+            (when, unless, self.separator.join(specs), len(specs)) for (when, unless), specs in self.groups
+        )
+        # A loop without conditional segments renders with one format_map call
+        self.unconditional = None
+        if len(self.groups) == 1 and self.groups[0][:2] == (None, None):
+            self.unconditional = self.groups[0][2:]
+
+    @staticmethod
+    def _compile(spec, element_separator, sub_element_separator):
+        """Swap in the separators and escape literal braces, leaving fields as they are"""
+        parts = []
+        for literal, field, format_spec, conversion in Formatter().parse(spec):
+            literal = literal.replace('*', element_separator).replace(':', sub_element_separator)
+            parts.append(literal.replace('{', '{{').replace('}', '}}'))
+            if field is not None:
+                parts.append('{' + field + (f"!{conversion}" if conversion else '') +
+                             (f":{format_spec}" if format_spec else '') + '}')
+        return ''.join(parts)
+
+    def render(self, values):
+        """Render the loop for one record and return (text, segment count)"""
+        if self.unconditional is not None:
+            template, count = self.unconditional
+            return template.format_map(values), count
+        texts = []
+        count = 0
+        for when, unless, template, segment_count in self.groups:
+            if when is not None and not values[when]:
+                continue
+            if unless is not None and values[unless]:
+                continue
+            texts.append(template.format_map(values))
+            count += segment_count
+        return self.separator.join(texts), count
@@ -1,20 +1,22 @@
+import asyncio
+import hashlib
 import json
+import re
 from pathlib import Path
-from typing import Dict, Optional
+from typing import Dict, Iterable, List, Optional, Tuple
 
-from google import genai
-
-from doc import loadingBar
 from doc.debugPrint import Log, genDebugFunction
+from doc.llm import DEFAULT_MODEL, LLMError, getClient
 from doc.processing import getJsonDict
+from doc.toc import getSections
 
 from .model import DocuLink
 
 printf = genDebugFunction()
 
 
-def critic(brd: str, cg: str, apiToken: str):
-    prompt = f"""Given a companion guide(cg) and its business require document(brd), critique the brd and provide a review of the document.
+def getCriticPrompt(brd: str, cg: str) -> str:
+    return f"""Given a companion guide(cg) and its business require document(brd), critique the brd and provide a review of the document.
     Also provide a score between 0 to 1 which denotes the quality and similarity of the converted BRD.
     Focus on improving the clarity, completeness and regulatory compliance.
     Identify any gaps in requirement or missing references.
@@ -30,10 +32,23 @@ def critic(brd: str, cg: str, apiToken: str):
 
 """
 
-    resp = callAgent(prompt, apiToken)
-    if resp:
-        return getJsonDict(resp)
-    return {}
+
+def critic(brd: str, cg: str, apiToken: str):
+    return asyncio.run(criticAsync(brd, cg, apiToken))
+
+
+async def criticAsync(brd: str, cg: str, apiToken: str):
+    prompt = getCriticPrompt(brd, cg)
+    resp = await callAgentAsync(prompt, apiToken)
+    try:
+        feedback = getJsonDict(resp) if resp else {}
+    except json.decoder.JSONDecodeError:
+        getClient(apiToken).forget(prompt)
+        raise
+    if "score" not in feedback:
+        # Forget the unusable reply, so the retry asks the model again
+        getClient(apiToken).forget(prompt)
+    return feedback
 
 
 # def improve(doc: DocuLink, apiToken: Optional[str]):
@@ -59,76 +74,123 @@ def critic(brd: str, cg: str, apiToken: str):
 
 
 def agenticImprove(doc: DocuLink, apiToken: str, scoreThreshold=0.85, maxItrs=10):
-    proc = loadingBar.LoadingAnim(doneMessage="", loadingMessage="Improving")
-    proc.start("Improving BRD")
+    """Blocking agenticImproveAsync"""
+    return asyncio.run(agenticImproveAsync(doc, apiToken, scoreThreshold, maxItrs))
+
+
+async def agenticImproveAsync(
+    doc: DocuLink, apiToken: str, scoreThreshold=0.85, maxItrs=10
+):
+    """
+    Critique and improve a BRD until it scores scoreThreshold.
+
+    Progress is printed per guide, so several guides can be improved at once.
+    """
     if doc.mdPath:
         cg = open(doc.mdPath, "r").read()
     else:
-        proc.stop()
         raise ValueError("CG Markdown File Not Found")
 
     if doc.brdPath:
         brd = open(doc.brdPath, "r").read()
     else:
-        proc.stop()
         raise ValueError("Base BRD Not Found")
+    brd, improvements = await improveTextAsync(
+        brd, cg, apiToken, doc.guideName, scoreThreshold, maxItrs
+    )
+    doc.improveCounter += improvements
+    with open(doc.brdPath, "w") as f:
+        f.write(brd)
+    printf(f"{doc.guideName} improved {doc.improveCounter} times", Log.SUC)
+    return doc
+
+
+async def improveTextAsync(
+    brd: str, cg: str, apiToken: str, label: str, scoreThreshold=0.85, maxItrs=10
+) -> Tuple[str, int]:
+    """
+    Critique and improve BRD text against its CG text until it scores scoreThreshold.
+
+    Args:
+        brd: BRD markdown to improve
+        cg: CG markdown the BRD was written from
+        apiToken: Gemini API key
+        label: Name printed with progress messages
+        scoreThreshold: Critic score at which the BRD is accepted
+        maxItrs: Most critic rounds, counting failed ones
+
+    Returns:
+        The improved BRD, as far as it got, and the number of improvements made
+    """
+    improvements = 0
     currentScore = 0
     itr = 0
     errItrs = 0
     while (currentScore < scoreThreshold) and ((itr + errItrs) < maxItrs):
-        proc.start()
         itr += 1
         try:
-            feedback = critic(brd, cg, apiToken)
+            feedback = await criticAsync(brd, cg, apiToken)
             if "score" not in feedback:
-                # print(feedback.keys())
                 raise TypeError("Score not found in reply.")
             if "critic" not in feedback:
-                print("No critic provided, finalizing document.")
+                printf(f"{label}: No critic provided, finalizing document.")
                 break
         except json.decoder.JSONDecodeError as e:
-            proc.stop()
-            printf("Didnt receive proper json critic from Agent, retrying...", Log.ERR)
-            printf("*" * 50, Log.ERR)
-            print(e)
-            printf("*" * 50, Log.ERR)
+            printf(
+                f"{label}: Didnt receive proper json critic from Agent, retrying... ({e})",
+                Log.ERR,
+            )
             errItrs += 1
             itr -= 1
             if errItrs >= (maxItrs // 2):
-                proc.stop()
-                printf("Failed too many times, skipping improving document.", Log.ERR)
-                return doc
+                printf(
+                    f"{label}: Failed too many times, skipping improving document.",
+                    Log.ERR,
+                )
+                break
             continue
+        except LLMError as e:
+            printf(f"{label}: {e}, skipping improving document.", Log.ERR)
+            break
         except TypeError:
             errItrs += 1
             itr -= 1
             if errItrs >= (maxItrs // 2):
-                proc.stop()
                 printf(
-                    "Missed keys too many times, skipping improving doucment.", Log.ERR
+                    f"{label}: Missed keys too many times, skipping improving doucment.",
+                    Log.ERR,
                 )
+                break
             continue
         currentScore = feedback["score"]
-        critics = feedback["critic"]
-        newBRD = improveBRD(brd, cg, critics, apiToken)
+        try:
+            newBRD = await improveBRDAsync(brd, cg, feedback["critic"], apiToken)
+        except RuntimeError as e:
+            # Keep the BRD as it was rather than replacing it with nothing
+            printf(f"{label}: {e}, keeping the previous BRD.", Log.ERR)
+            errItrs += 1
+            itr -= 1
+            if errItrs >= (maxItrs // 2):
+                printf(
+                    f"{label}: Failed too many times, skipping improving document.",
+                    Log.ERR,
+                )
+                break
+            continue
         newBRD = newBRD.removeprefix("```markdown")
-        newBRD = newBRD.removesuffix("```")
-        doc.improveCounter += 1
-        proc.stop()
+        brd = newBRD.removesuffix("```")
+        improvements += 1
         printf(
-            "Improvement Itr: {}, Current Score: {}".format(
-                doc.improveCounter, currentScore
+            "{}: Improvement Itr: {}, Current Score: {}".format(
+                label, improvements, currentScore
             ),
             Log.INF,
         )
-    with open(doc.brdPath, "w") as f:
-        f.write(newBRD)
-    printf(f"{doc.guideName} improved {doc.improveCounter} times", Log.SUC)
-    return doc
+    return brd, improvements
 
 
-def improveBRD(brd: str, cg: str, feedback: str, apiToken: str) -> str:
-    prompt = f"""
+def getImprovePrompt(brd: str, cg: str, feedback: str) -> str:
+    return f"""
     Given a companion guide(CG), the business require document(BRD) and the a critic feedback of the BRD, improve the BRD based on the feedback and CG as reference and return the BRD.
     Dont perform drastic changes. Make sure the quality of the output doesnt deteriorate.
     Only provide the improved BRD markdown content and nothing else.
@@ -139,45 +201,261 @@ def improveBRD(brd: str, cg: str, feedback: str, apiToken: str) -> str:
 
     feedback on BRD: {feedback}
     """
-    return callAgent(prompt, apiToken)
+
+
+def improveBRD(brd: str, cg: str, feedback: str, apiToken: str) -> str:
+    return asyncio.run(improveBRDAsync(brd, cg, feedback, apiToken))
+
+
+async def improveBRDAsync(brd: str, cg: str, feedback: str, apiToken: str) -> str:
+    return requireReply(
+        await callAgentAsync(getImprovePrompt(brd, cg, feedback), apiToken)
+    )
 
 
 def convertToBRD(doc: DocuLink, apiToken: Optional[str]):
-    proc = loadingBar.LoadingAnim()
-    proc.start(loadingMessage="Conterting to BRD")
+    """Blocking convertToBRDAsync"""
+    return asyncio.run(convertToBRDAsync(doc, apiToken))
+
+
+async def convertToBRDAsync(doc: DocuLink, apiToken: Optional[str]):
     if apiToken is None:
-        proc.stop()
         raise ValueError("Empty api key")
-    if doc.mdPath:
-        pass
-    else:
-        proc.stop()
+    if not doc.mdPath:
         raise FileNotFoundError(doc.mdPath)
     mdData = open(doc.mdPath).read()
-    prompt = f"""
+    brdData = requireReply(await callAgentAsync(getBRDPrompt(mdData), apiToken))
+    saveBRD(doc, brdData)
+    return doc
+
+
+def getBRDPrompt(mdData: str) -> str:
+    return f"""
             {mdData} \nConsider the above content as a companion guide, provide the business requirement document in markdown format.
             Make sure to include the business requirements in table format, each with unique IDs.
             Only provide the markdown content and nothing else"""
 
-    brdData = callAgent(prompt, apiToken)
-    if brdData is None:
-        proc.stop()
-        raise RuntimeError("No content receievd from api")
+
+def saveBRD(doc: DocuLink, brdData: str):
     brdData = brdData.removeprefix("```markdown")
     brdData = brdData.removesuffix("```")
     outputPath = Path("./data/brdMDs") / f"{doc.mdPath.stem}.brd.md"
     with open(outputPath, "w") as f:
         f.write(brdData)
     doc.brdPath = outputPath
-    proc.stop()
+
+
+# Consecutive CG sections are grouped into chunks of about this many
+# characters, and each chunk becomes one section of the BRD
+SECTION_MAX_CHARS = 12000
+BRD_TITLE = "# Business Requirement Document"
+
+
+def groupSections(
+    sections: List[Tuple[str, str]],
+    maxChars: int = SECTION_MAX_CHARS,
+    boundaries: Iterable[str] = (),
+) -> List[List[Tuple[str, str]]]:
+    """
+    Group consecutive CG sections into chunks of at most maxChars, or one larger section.
+
+    A section whose heading is in boundaries always starts a new chunk, so
+    chunks keep the boundaries of an earlier BRD and edits to one chunk
+    don't shift the others.
+    """
+    boundaries = set(boundaries)
+    chunks = []
+    size = 0
+    for section in sections:
+        if chunks and size + len(section[1]) <= maxChars and section[0] not in boundaries:
+            chunks[-1].append(section)
+            size += len(section[1])
+        else:
+            chunks.append([section])
+            size = len(section[1])
+    return chunks
+
+
+def getSectionPrompt(cg: str, titles: List[str], sectionNumber: int) -> str:
+    covered = ", ".join(title for title in titles if title) or "the opening pages"
+    return f"""
+            {cg} \nConsider the above content as part of a companion guide, covering {covered}.
+            Provide the business requirements for this part only, as a section of a business requirement document in markdown format.
+            Start the section with a level 2 heading naming the part of the guide it covers, and use level 3 or lower headings inside it.
+            Make sure to include the business requirements in table format, each with a unique ID of the form BR-{sectionNumber:02d}-001, BR-{sectionNumber:02d}-002 and so on.
+            If this part holds no business requirements, reply with the heading only.
+            Only provide the markdown content and nothing else"""
+
+
+def numberRequirementIds(brd: str, sectionNumber: int) -> str:
+    """
+    Give every requirement ID the section number, e.g. BR-001 or BR-07-001 to BR-03-001.
+
+    The model may leave the number out or put in a wrong one, and either
+    would clash with IDs of other sections.
+    """
+    return re.sub(
+        r"\b(BR|REQ)-(?:\d+-)?(\d+)\b",
+        lambda match: f"{match[1]}-{sectionNumber:02d}-{match[2]}",
+        brd,
+    )
+
+
+def stitchBRD(sections: List[str]) -> str:
+    """Join BRD sections, in CG order, under one title"""
+    return "\n\n".join([BRD_TITLE] + [section.strip() for section in sections]) + "\n"
+
+
+async def generateSectionAsync(
+    chunk: List[Tuple[str, str]],
+    sectionNumber: int,
+    apiToken: str,
+    label: str,
+    improve=True,
+    scoreThreshold=0.85,
+    maxItrs=10,
+) -> Tuple[str, int]:
+    """
+    Write the BRD section for one chunk of CG sections, critiqued against that chunk only.
+
+    Returns:
+        The BRD section and the number of improvements made to it
+    """
+    cg = "\n".join(text for _, text in chunk)
+    brd = requireReply(
+        await callAgentAsync(
+            getSectionPrompt(cg, [title for title, _ in chunk], sectionNumber), apiToken
+        )
+    )
+    brd = brd.removeprefix("```markdown").removesuffix("```")
+    improvements = 0
+    if improve:
+        brd, improvements = await improveTextAsync(
+            brd, cg, apiToken, f"{label} section {sectionNumber}", scoreThreshold, maxItrs
+        )
+    return numberRequirementIds(brd, sectionNumber), improvements
+
+
+def getChunkHash(chunk: List[Tuple[str, str]]) -> str:
+    return hashlib.sha256("\n".join(text for _, text in chunk).encode()).hexdigest()
+
+
+def getSectionMapPath(brdPath: Path) -> Path:
+    """Where a chunked BRD records which CG sections each of its sections came from"""
+    return Path(brdPath).with_suffix(".sections.json")
+
+
+def loadSectionMap(brdPath: Optional[Path]) -> List[Dict]:
+    if brdPath is None or not getSectionMapPath(brdPath).exists():
+        return []
+    with open(getSectionMapPath(brdPath)) as f:
+        return json.load(f)["sections"]
+
+
+def saveSectionMap(brdPath: Path, sections: List[Dict]):
+    with open(getSectionMapPath(brdPath), "w") as f:
+        json.dump({"sections": sections}, f, indent=2)
+
+
+async def convertToBRDChunkedAsync(
+    doc: DocuLink,
+    apiToken: Optional[str],
+    improve=True,
+    maxChars: int = SECTION_MAX_CHARS,
+    scoreThreshold=0.85,
+    maxItrs=10,
+    previousBRD: Optional[Path] = None,
+):
+    """
+    Convert a CG to a BRD section by section, for guides too large for one prompt.
+
+    The CG is split at its level 1 and 2 headers, grouped into chunks of
+    about maxChars, and each chunk's BRD section is generated (and, with
+    improve, critiqued and improved) concurrently. Requirement IDs carry
+    the section number, so they stay unique across sections, and the
+    sections are joined in CG order.
+
+    Next to the BRD, a section map records the CG headings and a hash of
+    the CG text behind each BRD section. Given the BRD of an earlier
+    revision of the guide as previousBRD, chunks keep that BRD's
+    boundaries, sections whose CG text is unchanged are reused as they
+    are, and only the rest are generated and critiqued again. A changed
+    section keeps its number, so its requirement IDs stay stable. A
+    previousBRD without a section map, e.g. one written in a single
+    prompt, has every section generated, and its map makes the next
+    update incremental.
+    """
+    if apiToken is None:
+        raise ValueError("Empty api key")
+    if not doc.mdPath:
+        raise FileNotFoundError(doc.mdPath)
+    previous = loadSectionMap(previousBRD)
+    chunks = groupSections(
+        getSections(open(doc.mdPath).read()),
+        maxChars,
+        [entry["headings"][0] for entry in previous],
+    )
+    previousByHash = {entry["hash"]: entry for entry in previous}
+    previousByHeadings = {tuple(entry["headings"]): entry for entry in previous}
+
+    sections = []
+    pending = []
+    usedNumbers = set()
+    for chunk in chunks:
+        headings = [title for title, _ in chunk]
+        chunkHash = getChunkHash(chunk)
+        entry = previousByHash.get(chunkHash)
+        if entry is not None and entry["number"] not in usedNumbers:
+            sections.append(dict(entry, headings=headings))
+        else:
+            entry = previousByHeadings.get(tuple(headings))
+            sections.append({"number": None, "headings": headings, "hash": chunkHash})
+            pending.append((chunk, sections[-1], entry))
+        if sections[-1]["number"] is not None:
+            usedNumbers.add(sections[-1]["number"])
+    nextNumber = max(usedNumbers | {entry["number"] for entry in previous}, default=0)
+    for _, section, entry in pending:
+        if entry is not None and entry["number"] not in usedNumbers:
+            section["number"] = entry["number"]
+        else:
+            nextNumber += 1
+            section["number"] = nextNumber
+        usedNumbers.add(section["number"])
+
+    printf(
+        f"Converting {doc.guideName} to BRD: {len(pending)} of {len(chunks)} sections "
+        "to generate",
+        Log.INF,
+    )
+    results = await asyncio.gather(
+        *(
+            generateSectionAsync(
+                chunk,
+                section["number"],
+                apiToken,
+                doc.guideName,
+                improve,
+                scoreThreshold,
+                maxItrs,
+            )
+            for chunk, section, _ in pending
+        )
+    )
+    for (_, section, _), (brd, improvements) in zip(pending, results):
+        section["brd"] = brd
+        doc.improveCounter += improvements
+    saveBRD(doc, stitchBRD([section["brd"] for section in sections]))
+    saveSectionMap(doc.brdPath, sections)
     return doc
 
 
-def getDiffPoints(oldDoc: str, newDoc: str, apiToken: str) -> Dict:
-    oldDocData = oldDoc
-    newDocData = newDoc
+def convertToBRDChunked(doc: DocuLink, apiToken: Optional[str], **kwargs):
+    """Blocking convertToBRDChunkedAsync"""
+    return asyncio.run(convertToBRDChunkedAsync(doc, apiToken, **kwargs))
+
 
-    prompt = f"""
+def getDiffPrompt(oldDocData: str, newDocData: str) -> str:
+    return f"""
     Below provided are the old and the new versions of a Business Requirement Document.
     Identify and list the key differences found in the new version.
     Reply in json format.
@@ -188,10 +466,22 @@ def getDiffPoints(oldDoc: str, newDoc: str, apiToken: str) -> Dict:
     New BRD: {newDocData}
     """
 
-    # client = genai.Client(api_key=apiToken)
-    # response = client.models.generate_content(model="gemini-2.0-flash", contents=prompt)
-    diffData = callAgent(prompt, apiToken)
-    if diffData == "":
+
+def getDiffPoints(oldDoc: str, newDoc: str, apiToken: str) -> Dict:
+    return asyncio.run(getDiffPointsAsync(oldDoc, newDoc, apiToken))
+
+
+async def getDiffPointsAsync(oldDoc: str, newDoc: str, apiToken: str) -> Dict:
+    prompt = getDiffPrompt(oldDoc, newDoc)
+    diffData = await callAgentAsync(prompt, apiToken)
+    diffPoints = parseDiffPoints(diffData)
+    if "changes" not in diffPoints:
+        getClient(apiToken).forget(prompt)
+    return diffPoints
+
+
+def parseDiffPoints(diffData: Optional[str]) -> Dict:
+    if not diffData:
         raise RuntimeError("No content receievd from api")
     try:
         jsonDiff = getJsonDict(diffData)
@@ -202,10 +492,20 @@ def getDiffPoints(oldDoc: str, newDoc: str, apiToken: str) -> Dict:
         return {"count": 0}
 
 
-def callAgent(prompt: str, apiKey: str, model: str = "gemini-2.0-flash") -> str:
-    client = genai.Client(api_key=apiKey)
-    resp = client.models.generate_content(model=model, contents=prompt).text
-    if resp:
-        return resp
-    else:
-        ""
+def requireReply(reply: Optional[str]) -> str:
+    """The model's reply, raising RuntimeError if it sent nothing"""
+    if not reply:
+        raise RuntimeError("No content receievd from api")
+    return reply
+
+
+def callAgent(
+    prompt: str, apiKey: str, model: str = DEFAULT_MODEL, useCache: bool = True
+) -> Optional[str]:
+    return getClient(apiKey).generate(prompt, model, useCache)
+
+
+async def callAgentAsync(
+    prompt: str, apiKey: str, model: str = DEFAULT_MODEL, useCache: bool = True
+) -> Optional[str]:
+    return await getClient(apiKey).generateAsync(prompt, model, useCache)
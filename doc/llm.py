@@ -0,0 +1,251 @@
+import asyncio
+import os
+import random
+import threading
+import time
+from typing import Dict, List, Optional
+
+import httpx
+from google import genai
+from google.genai import errors, types
+
+from doc.debugPrint import Log, genDebugFunction
+from doc.llmCache import CACHE_BYPASS, LLMCache, getCache, getCacheKey
+
+printf = genDebugFunction()
+
+DEFAULT_MODEL = "gemini-2.0-flash"
+EMBEDDING_MODEL = "models/gemini-embedding-exp-03-07"
+
+# Request timeout, retries and in-flight requests per API key, overridable
+# from the environment. GEMINI_BASE_URL points the client at another server,
+# such as a local stub for testing.
+DEFAULT_TIMEOUT = float(os.getenv("GEMINI_TIMEOUT", "120"))
+DEFAULT_MAX_RETRIES = int(os.getenv("GEMINI_MAX_RETRIES", "5"))
+DEFAULT_MAX_CONCURRENCY = int(os.getenv("GEMINI_MAX_CONCURRENCY", "4"))
+RETRY_BASE_DELAY = 1.0
+RETRY_MAX_DELAY = 60.0
+RETRY_STATUS_CODES = frozenset({408, 429, 500, 502, 503, 504})
+
+
+class LLMError(RuntimeError):
+    """A Gemini call that failed for good, after any retries"""
+
+
+class LLMClient(object):
+    """
+    One Gemini client per API key, shared by every caller in the process.
+
+    The underlying genai.Client keeps its HTTP connections open between
+    calls. A semaphore bounds the requests in flight, and calls that fail
+    with a rate limit, a server error, a timeout or a dropped connection
+    are retried with exponential backoff and full jitter, honouring any
+    Retry-After the server sends.
+
+    The Async methods do the same on the client's asyncio interface. An
+    asyncio connection pool only works on the event loop that opened it,
+    so the client runs those calls on an event loop thread of its own,
+    and callers on any loop, e.g. successive asyncio.run() calls, share
+    its one pool.
+
+    Generated text is stored in the response cache, if there is one, and
+    repeated prompts are answered from it. Pass useCache=False to make a
+    fresh call; GEMINI_CACHE_BYPASS=1 does so for every call. Callers
+    that find a reply unusable, e.g. JSON that doesn't parse, forget it so
+    that asking again reaches the model.
+    """
+
+    def __init__(
+        self,
+        apiKey: str,
+        timeout: float = DEFAULT_TIMEOUT,
+        maxRetries: int = DEFAULT_MAX_RETRIES,
+        maxConcurrency: int = DEFAULT_MAX_CONCURRENCY,
+        baseUrl: Optional[str] = None,
+        cache: Optional[LLMCache] = None,
+    ):
+        self.cache = cache
+        self.maxRetries = maxRetries
+        self.maxConcurrency = maxConcurrency
+        self.semaphore = threading.BoundedSemaphore(maxConcurrency)
+        self.asyncSemaphore: Optional[asyncio.Semaphore] = None
+        self.asyncLoop: Optional[asyncio.AbstractEventLoop] = None
+        self.asyncLoopLock = threading.Lock()
+        self.client = genai.Client(
+            api_key=apiKey,
+            http_options=types.HttpOptions(
+                timeout=int(timeout * 1000),
+                base_url=baseUrl or os.getenv("GEMINI_BASE_URL"),
+            ),
+        )
+
+    def generate(
+        self, prompt: str, model: str = DEFAULT_MODEL, useCache: bool = True
+    ) -> Optional[str]:
+        """Generate text for a prompt, returning None when the model sends none"""
+        key = getCacheKey(model, prompt)
+        text = self.getCached(key, useCache)
+        if text is None:
+            response = self.call(
+                self.client.models.generate_content, model=model, contents=prompt
+            )
+            text = response.text
+            self.putCached(key, text)
+        return text
+
+    def embed(self, contents: List[str], model: str = EMBEDDING_MODEL) -> List[List[float]]:
+        response = self.call(
+            self.client.models.embed_content, model=model, contents=contents
+        )
+        return [embedding.values for embedding in response.embeddings]
+
+    def call(self, function, *args, **kwargs):
+        """
+        Call a genai client method under the semaphore, retrying transient failures.
+
+        Args:
+            function: Bound method of the genai client
+            *args, **kwargs: Arguments of the method
+
+        Returns:
+            The method's response
+
+        Raises:
+            LLMError: The call failed and could not be retried
+        """
+        attempt = 0
+        while True:
+            try:
+                with self.semaphore:
+                    return function(*args, **kwargs)
+            except (errors.APIError, httpx.TimeoutException, httpx.TransportError) as e:
+                time.sleep(self.getBackoff(attempt, e))
+                attempt += 1
+
+    async def generateAsync(
+        self, prompt: str, model: str = DEFAULT_MODEL, useCache: bool = True
+    ) -> Optional[str]:
+        key = getCacheKey(model, prompt)
+        text = self.getCached(key, useCache)
+        if text is None:
+            response = await self.callAsync(
+                lambda client: client.models.generate_content,
+                model=model,
+                contents=prompt,
+            )
+            text = response.text
+            self.putCached(key, text)
+        return text
+
+    def forget(self, prompt: str, model: str = DEFAULT_MODEL):
+        """Drop the cached reply to a prompt"""
+        if self.cache is not None:
+            self.cache.delete(getCacheKey(model, prompt))
+
+    def getCached(self, key: str, useCache: bool) -> Optional[str]:
+        if self.cache is None or not useCache or CACHE_BYPASS:
+            return None
+        return self.cache.get(key)
+
+    def putCached(self, key: str, text: Optional[str]):
+        # Missing or empty replies are failures worth retrying, so they are never cached
+        if self.cache is not None and text:
+            self.cache.put(key, text)
+
+    async def embedAsync(
+        self, contents: List[str], model: str = EMBEDDING_MODEL
+    ) -> List[List[float]]:
+        response = await self.callAsync(
+            lambda client: client.models.embed_content, model=model, contents=contents
+        )
+        return [embedding.values for embedding in response.embeddings]
+
+    async def callAsync(self, getFunction, *args, **kwargs):
+        """
+        Await a genai asyncio client method under the semaphore, retrying transient failures.
+
+        Args:
+            getFunction: Takes the genai.Client.aio and returns the method to call
+            *args, **kwargs: Arguments of the method
+        """
+        future = asyncio.run_coroutine_threadsafe(
+            self.callOnLoop(getFunction, *args, **kwargs), self.getAsyncLoop()
+        )
+        return await asyncio.wrap_future(future)
+
+    async def callOnLoop(self, getFunction, *args, **kwargs):
+        """callAsync's retry loop, run on the client's own event loop"""
+        if self.asyncSemaphore is None:
+            self.asyncSemaphore = asyncio.Semaphore(self.maxConcurrency)
+        attempt = 0
+        while True:
+            try:
+                async with self.asyncSemaphore:
+                    return await getFunction(self.client.aio)(*args, **kwargs)
+            except (errors.APIError, httpx.TimeoutException, httpx.TransportError) as e:
+                await asyncio.sleep(self.getBackoff(attempt, e))
+                attempt += 1
+
+    def getAsyncLoop(self) -> asyncio.AbstractEventLoop:
+        """The event loop thread that runs the Async calls, started on first use"""
+        with self.asyncLoopLock:
+            if self.asyncLoop is None:
+                self.asyncLoop = asyncio.new_event_loop()
+                threading.Thread(
+                    target=self.asyncLoop.run_forever, name="gemini-aio", daemon=True
+                ).start()
+            return self.asyncLoop
+
+    def getBackoff(self, attempt: int, error: Exception) -> float:
+        """Seconds to wait before retrying a failed call, raising LLMError if it can't be retried"""
+        if not isRetryable(error) or attempt >= self.maxRetries:
+            raise LLMError(f"Gemini call failed: {error}") from error
+        delay = getRetryDelay(attempt, error)
+        printf(
+            f"Gemini call failed ({error}), retry {attempt + 1} in {delay:.1f}s",
+            Log.WRN,
+        )
+        return delay
+
+
+def isRetryable(error: Exception) -> bool:
+    if isinstance(error, errors.APIError):
+        return error.code in RETRY_STATUS_CODES
+    return True
+
+
+def getRetryDelay(attempt: int, error: Exception) -> float:
+    """Seconds to wait before a retry: the server's Retry-After, else full jitter backoff"""
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None)
+    if headers:
+        try:
+            return min(float(headers.get("retry-after", "")), RETRY_MAX_DELAY)
+        except ValueError:
+            pass
+    return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2**attempt))
+
+
+_clients: Dict[str, LLMClient] = {}
+_clientsLock = threading.Lock()
+
+
+def getClient(apiKey: Optional[str] = None) -> LLMClient:
+    """
+    Shared client for an API key, created on first use.
+
+    Args:
+        apiKey: Gemini API key, GEMINI_API_KEY from the environment by default
+
+    Returns:
+        The LLMClient for the key
+    """
+    apiKey = apiKey or os.getenv("GEMINI_API_KEY")
+    if not apiKey:
+        raise ValueError(
+            "Gemini API Key not provided. Please provide GEMINI_API_KEY as an environment variable"
+        )
+    with _clientsLock:
+        if apiKey not in _clients:
+            _clients[apiKey] = LLMClient(apiKey, cache=getCache())
+        return _clients[apiKey]
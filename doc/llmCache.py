@@ -0,0 +1,137 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Dict, Optional
+
+CACHE_PATH = Path(os.getenv("GEMINI_CACHE_PATH", "./data/llmCache.db"))
+CACHE_TTL = float(os.getenv("GEMINI_CACHE_TTL", str(30 * 24 * 3600)))
+CACHE_MAX_BYTES = int(float(os.getenv("GEMINI_CACHE_MAX_MB", "256")) * 1024 * 1024)
+CACHE_BYPASS = os.getenv("GEMINI_CACHE_BYPASS", "").lower() in ("1", "true", "yes")
+
+
+def getCacheKey(model: str, prompt: str, params: Optional[Dict] = None) -> str:
+    """
+    Content address of an LLM request.
+
+    Args:
+        model: Model name
+        prompt: Prompt text
+        params: Any other request parameters, which must be JSON serialisable
+
+    Returns:
+        SHA-256 hex digest of the model, prompt and parameters
+    """
+    digest = hashlib.sha256(model.encode())
+    digest.update(b"\0")
+    digest.update(json.dumps(params or {}, sort_keys=True).encode())
+    digest.update(b"\0")
+    digest.update(prompt.encode())
+    return digest.hexdigest()
+
+
+class LLMCache(object):
+    """
+    Responses of earlier LLM calls, kept in SQLite so reruns skip repeated calls.
+
+    Entries older than ttl seconds are treated as missing. Once the stored
+    responses pass maxBytes, the least recently used ones are dropped.
+    """
+
+    def __init__(
+        self,
+        path: Path = CACHE_PATH,
+        ttl: float = CACHE_TTL,
+        maxBytes: int = CACHE_MAX_BYTES,
+    ):
+        self.path = path
+        self.ttl = ttl
+        self.maxBytes = maxBytes
+        self.lock = threading.Lock()
+        os.makedirs(Path(path).parent, exist_ok=True)
+        self.conn = sqlite3.connect(str(path), timeout=30, check_same_thread=False)
+        self.conn.executescript(
+            """
+            PRAGMA journal_mode = WAL;
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                response TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                created_at REAL NOT NULL,
+                last_used REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_responses_last_used ON responses (last_used);
+            """
+        )
+
+    def get(self, key: str) -> Optional[str]:
+        now = time.time()
+        with self.lock, self.conn:
+            row = self.conn.execute(
+                "SELECT response, created_at FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            response, createdAt = row
+            if now - createdAt > self.ttl:
+                self.conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                return None
+            self.conn.execute(
+                "UPDATE responses SET last_used = ? WHERE key = ?", (now, key)
+            )
+        return response
+
+    def put(self, key: str, response: str):
+        now = time.time()
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO responses (key, response, size, created_at, last_used) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (key, response, len(response.encode()), now, now),
+            )
+            self.evict(now)
+
+    def delete(self, key: str):
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+
+    def evict(self, now: Optional[float] = None):
+        """Drop expired entries, then the least recently used ones past maxBytes"""
+        now = time.time() if now is None else now
+        self.conn.execute(
+            "DELETE FROM responses WHERE created_at < ?", (now - self.ttl,)
+        )
+        self.conn.execute(
+            """
+            DELETE FROM responses WHERE key IN (
+                SELECT key FROM (
+                    SELECT key, SUM(size) OVER (ORDER BY last_used DESC, key) AS total
+                    FROM responses
+                ) WHERE total > ?
+            )
+            """,
+            (self.maxBytes,),
+        )
+
+    def clear(self):
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM responses")
+
+    def close(self):
+        self.conn.close()
+
+
+_cache: Optional[LLMCache] = None
+_cacheLock = threading.Lock()
+
+
+def getCache() -> LLMCache:
+    """The response cache shared by every LLM client, opened on first use"""
+    global _cache
+    with _cacheLock:
+        if _cache is None:
+            _cache = LLMCache()
+        return _cache
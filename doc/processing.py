@@ -1,13 +1,19 @@
+import hashlib
 import json
 import os
 import re
+from concurrent.futures import ProcessPoolExecutor
+from importlib import metadata
 from pathlib import Path
+from typing import List, Optional
 
 import numpy as np
 
 # from markitdown import MarkItDown
+import pymupdf
 import pymupdf4llm
 from docling.document_converter import DocumentConverter
+from pymupdf4llm.helpers.pymupdf_rag import IdentifyHeaders
 
 from doc.network import getFileNameFromLink
 
@@ -15,6 +21,12 @@ from .model import DocuLink
 
 PAGEBREAK = '<div style="page-break-after: always;"></div>'
 
+CONVERTED_MD_DIR = Path("./data/convertedMDs")
+MD_CACHE_DIR = CONVERTED_MD_DIR / "cache"
+PAGE_CACHE_DIR = CONVERTED_MD_DIR / "pages"
+HASH_CHUNK_SIZE = 1 << 20
+PAGES_PER_TASK = 8
+
 
 def DLinkFromNumpy(array: np.ndarray):
     link = DocuLink(
@@ -39,27 +51,242 @@ def DLinkFromNumpy(array: np.ndarray):
     return link
 
 
+def getConverterVersion(package: str) -> str:
+    try:
+        return metadata.version(package)
+    except metadata.PackageNotFoundError:
+        return "unknown"
+
+
+def getConversionKey(pdfPath: Path, converter: str, version: str) -> str:
+    """
+    Content address of a PDF conversion.
+
+    Args:
+        pdfPath: PDF to convert
+        converter: Name of the converter package
+        version: Version of the converter package
+
+    Returns:
+        SHA-256 hex digest of the PDF bytes, the converter name and its version
+    """
+    digest = hashlib.sha256()
+    with open(pdfPath, "rb") as f:
+        while chunk := f.read(HASH_CHUNK_SIZE):
+            digest.update(chunk)
+    digest.update(f"\0{converter}\0{version}".encode())
+    return digest.hexdigest()
+
+
+def getPageLayout(page: pymupdf.Page) -> str:
+    """
+    Everything on a page that pymupdf4llm's markdown depends on.
+
+    Covers each text span's text, font, size, style flags and position,
+    the position of each image and of each vector drawing (which is how
+    table borders are found), rounded to a tenth of a point.
+    """
+    items = []
+    for block in page.get_text("dict")["blocks"]:
+        if block["type"] == 1:
+            items.append(("image", roundBox(block["bbox"])))
+        for line in block.get("lines", ()):
+            for span in line["spans"]:
+                items.append(
+                    (
+                        span["text"],
+                        span["font"],
+                        round(span["size"], 1),
+                        span["flags"],
+                        roundBox(span["bbox"]),
+                    )
+                )
+    for drawing in page.get_drawings():
+        items.append(("drawing", roundBox(drawing["rect"]), drawing["fill"] is not None))
+    return repr(items)
+
+
+def roundBox(box) -> tuple:
+    return tuple(round(value, 1) for value in box)
+
+
+def getPageKeys(pdfPath: Path, converter: str, version: str) -> List[str]:
+    """
+    Content address of each page of a PDF.
+
+    Pages are keyed by their layout (see getPageLayout) and size, so two
+    pages share a key only when the converter would produce the same
+    markdown for them. The document's header font sizes are part of every
+    key, since they decide each page's heading levels.
+
+    Args:
+        pdfPath: PDF to convert
+        converter: Name of the converter package
+        version: Version of the converter package
+
+    Returns:
+        SHA-256 hex digest of each page, in page order
+    """
+    keys = []
+    with pymupdf.open(pdfPath) as pdf:
+        headers = IdentifyHeaders(pdf)
+        headerSizes = sorted(headers.header_id.items()), headers.body_limit
+        for page in pdf:
+            digest = hashlib.sha256(
+                f"{converter}\0{version}\0{headerSizes}\0{tuple(page.rect)}\0".encode()
+            )
+            digest.update(getPageLayout(page).encode())
+            keys.append(digest.hexdigest())
+    return keys
+
+
+def getCachedMarkdown(key: str, cacheDir: Path = MD_CACHE_DIR) -> Optional[str]:
+    cachePath = cacheDir / f"{key}.md"
+    if cachePath.exists():
+        return cachePath.read_text()
+    return None
+
+
+def cacheMarkdown(key: str, data: str, cacheDir: Path = MD_CACHE_DIR):
+    os.makedirs(cacheDir, exist_ok=True)
+    cachePath = cacheDir / f"{key}.md"
+    # Write then rename so an interrupted run never leaves a partial entry
+    tmpPath = cachePath.with_suffix(f".{os.getpid()}.tmp")
+    saveMarkdown(data, tmpPath)
+    os.replace(tmpPath, cachePath)
+
+
+def convertCached(pdfPath: Path, converter: str, convert) -> str:
+    """
+    Convert a PDF to markdown, reusing an earlier conversion of the same content.
+
+    The cache is keyed by the PDF content and the converter's name and
+    version, so renamed or re-downloaded copies of a guide are converted
+    only once, and upgrading the converter converts them again.
+
+    Args:
+        pdfPath: PDF to convert
+        converter: Package name of the converter, used for its version
+        convert: Function converting the PDF path to markdown text
+
+    Returns:
+        Markdown text of the PDF
+    """
+    key = getConversionKey(pdfPath, converter, getConverterVersion(converter))
+    data = getCachedMarkdown(key)
+    if data is None:
+        data = convert(pdfPath)
+        cacheMarkdown(key, data)
+    return data
+
+
 def convertToMarkdown(doc: DocuLink):
     # md = MarkItDown()
     if doc.pdfPath:
         # data = md.convert_local(doc.pdfPath)
-        data = pymupdf4llm.to_markdown(doc.pdfPath)
+        data = convertCached(doc.pdfPath, "pymupdf4llm", pymupdf4llm.to_markdown)
         # print(data.text_content)
-        mdPath = Path("./data/convertedMDs") / f"{doc.pdfPath.stem}.pymu.md"
+        mdPath = CONVERTED_MD_DIR / f"{doc.pdfPath.stem}.pymu.md"
         saveMarkdown(data, mdPath)
         doc.mdPath = mdPath
     return doc
 
 
+def convertPageRange(pdfPath: str, pages: List[int]) -> List[str]:
+    """
+    Convert some pages of a PDF to markdown, one string per page.
+
+    Heading levels come from the font sizes of the whole document, and each
+    page is converted on its own: pymupdf4llm's output for a page otherwise
+    depends on the other pages converted with it, which would make cached
+    pages differ by the run that converted them.
+    """
+    with pymupdf.open(pdfPath) as pdf:
+        headers = IdentifyHeaders(pdf)
+        return [
+            pymupdf4llm.to_markdown(
+                pdf, pages=[page], page_chunks=True, hdr_info=headers
+            )[0]["text"]
+            for page in pages
+        ]
+
+
+def getPageRanges(pages: List[int], pagesPerTask: int) -> List[List[int]]:
+    """Group page numbers into runs of consecutive pages, at most pagesPerTask long"""
+    ranges = []
+    for page in pages:
+        if ranges and page == ranges[-1][-1] + 1 and len(ranges[-1]) < pagesPerTask:
+            ranges[-1].append(page)
+        else:
+            ranges.append([page])
+    return ranges
+
+
+def convertToMarkdownPaged(
+    doc: DocuLink, workers: Optional[int] = None, pagesPerTask: int = PAGES_PER_TASK
+):
+    """
+    Convert a PDF to markdown page by page, reusing pages converted before.
+
+    Each page is cached under the hash of its layout, so a new revision of a
+    guide saved by the same PDF producer only converts the pages that
+    changed. A revision saved by another producer lays out every page
+    slightly differently, so none of its pages are reused and it is
+    converted in full; inst2.pdf after inst1.pdf is such a case. Pages
+    missing from the cache are converted in runs of consecutive pages
+    across a process pool and the pages are joined with PAGEBREAK.
+
+    Args:
+        doc: Document with the PDF to convert
+        workers: Number of conversion processes, one per CPU by default
+        pagesPerTask: Most pages converted by one process at a time
+
+    Returns:
+        The document with mdPath set
+    """
+    if doc.pdfPath:
+        keys = getPageKeys(
+            doc.pdfPath, "pymupdf4llm", getConverterVersion("pymupdf4llm")
+        )
+        pages = [getCachedMarkdown(key, PAGE_CACHE_DIR) for key in keys]
+        missing = [number for number, page in enumerate(pages) if page is None]
+        ranges = getPageRanges(missing, pagesPerTask)
+        if len(ranges) > 1 and workers != 1:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                converted = executor.map(
+                    convertPageRange, [str(doc.pdfPath)] * len(ranges), ranges
+                )
+                for pageRange, texts in zip(ranges, converted):
+                    for number, text in zip(pageRange, texts):
+                        pages[number] = text
+                        cacheMarkdown(keys[number], text, PAGE_CACHE_DIR)
+        else:
+            for pageRange in ranges:
+                for number, text in zip(
+                    pageRange, convertPageRange(str(doc.pdfPath), pageRange)
+                ):
+                    pages[number] = text
+                    cacheMarkdown(keys[number], text, PAGE_CACHE_DIR)
+        mdPath = CONVERTED_MD_DIR / f"{doc.pdfPath.stem}.pymu.md"
+        saveMarkdown(f"\n{PAGEBREAK}\n".join(pages), mdPath)
+        doc.mdPath = mdPath
+    return doc
+
+
 def convertToMarkdownDocLing(doc: DocuLink):
     # md = MarkItDown()
-    md = DocumentConverter()
     if doc.pdfPath:
-        data = md.convert(doc.pdfPath)
+        data = convertCached(
+            doc.pdfPath,
+            "docling",
+            lambda pdfPath: DocumentConverter()
+            .convert(pdfPath)
+            .document.export_to_markdown(),
+        )
         # data = pymupdf4llm.to_markdown(doc.pdfPath)
         # print(data.text_content)
-        mdPath = Path("./data/convertedMDs") / f"{doc.pdfPath.stem}.docling.md"
-        saveMarkdown(data.document.export_to_markdown(), mdPath)
+        mdPath = CONVERTED_MD_DIR / f"{doc.pdfPath.stem}.docling.md"
+        saveMarkdown(data, mdPath)
         doc.mdPath = mdPath
     return doc
 
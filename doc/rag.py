@@ -1,15 +1,17 @@
+import asyncio
 import json
 import os
 from hashlib import md5
 from pathlib import Path
+from typing import Optional
 
 import chromadb
-import google.genai as genai
 from chromadb import Documents, EmbeddingFunction, Embeddings
 from dotenv import load_dotenv
 from tqdm.auto import tqdm
 
 from doc.debugPrint import Log, genDebugFunction
+from doc.llm import getClient
 from doc.processing import getJsonDict
 
 load_dotenv()
@@ -97,14 +99,10 @@ class DocuRAG(object):
         return prompt
 
     def callPrompt(self, prompt):
-        client = genai.Client(api_key=self.apiKey)
-        response = client.models.generate_content(
-            model="gemini-2.0-flash", contents=prompt
-        )
-        if response.text:
-            return response.text
-        else:
-            return ""
+        return getClient(self.apiKey).generate(prompt)
+
+    async def callPromptAsync(self, prompt):
+        return await getClient(self.apiKey).generateAsync(prompt)
 
     def getRelatedText(self, query, resultCount=3):
         res = self.db.query(query_texts=[query], n_results=resultCount)["documents"][0][
@@ -117,8 +115,13 @@ class DocuRAG(object):
         prompt = self.formatPrompt(query=query, ragMatch=relevantText)
         return self.callPrompt(prompt)
 
-    def getCodeSuggestion(self, change: str):
-        prompt = f"""
+    async def generateAsync(self, query: str):
+        relevantText = await asyncio.to_thread(self.getRelatedText, query)
+        prompt = self.formatPrompt(query=query, ragMatch=relevantText)
+        return await self.callPromptAsync(prompt)
+
+    def getCodeSuggestionPrompt(self, change: str):
+        return f"""
         For the given suggestion, provide the relevant modified code: {change}.
         Reply in json format, with the mandatory key "count", denoting the number of code changes for the given suggestion.
         If no changes are necessary, reply in json format with count equal to 0.
@@ -131,25 +134,39 @@ class DocuRAG(object):
 
         make sure the json keys are properly present.
         """
+
+    def getCodeSuggestion(self, change: str):
         relevantText = self.getRelatedText(change)
-        prompt = self.formatPrompt(query=prompt, ragMatch=relevantText)
-        return getJsonDict(self.callPrompt(prompt))
+        prompt = self.formatPrompt(
+            query=self.getCodeSuggestionPrompt(change), ragMatch=relevantText
+        )
+        return self.parseCodeSuggestion(prompt, self.callPrompt(prompt))
+
+    async def getCodeSuggestionAsync(self, change: str):
+        # Chroma queries block, so the lookup and its embedding call run in a thread
+        relevantText = await asyncio.to_thread(self.getRelatedText, change)
+        prompt = self.formatPrompt(
+            query=self.getCodeSuggestionPrompt(change), ragMatch=relevantText
+        )
+        return self.parseCodeSuggestion(prompt, await self.callPromptAsync(prompt))
+
+    def parseCodeSuggestion(self, prompt: str, reply: Optional[str]):
+        if not reply:
+            return {}
+        # Unusable replies are dropped from the cache, so asking again gets a fresh one
+        try:
+            suggestion = getJsonDict(reply)
+        except json.decoder.JSONDecodeError:
+            getClient(self.apiKey).forget(prompt)
+            raise
+        if "count" not in suggestion:
+            getClient(self.apiKey).forget(prompt)
+        return suggestion
 
 
 class GeminiEmbeddingFunction(EmbeddingFunction):
     def __call__(self, input: Documents) -> Embeddings:
-        gemini_api_key = os.getenv("GEMINI_API_KEY")
-        if not gemini_api_key:
-            raise ValueError(
-                "Gemini API Key not provided. Please provide GEMINI_API_KEY as an environment variable"
-            )
-        client = genai.Client(api_key=gemini_api_key)
-        model = "models/gemini-embedding-exp-03-07"
-        emb = client.models.embed_content(
-            model=model,
-            contents=[input],
-        ).embeddings
-        return [i.values for i in emb]
+        return getClient().embed([input])
 
 
 # if __name__ == "__main__":
@@ -120,3 +120,33 @@ def getTOC(data: str, depth=2) -> List[str]:
 
     toc = create_toc(toc_levels, depth)
     return toc
+
+
+def getSections(data: str, depth=2) -> List[Tuple[str, str]]:
+    """Splits markdown into sections at each header up to the given level.
+
+    Text before the first header becomes a section with an empty header, and
+    headers inside code blocks are ignored, as in getTOC.
+
+    :param data: markdown text
+    :param depth: deepest header level that starts a new section
+    :return: (header, text) of each section in document order, the text including its header line
+    """
+    sections = []
+    header = ""
+    lines = []
+    code_block = False
+
+    for line in data.split("\n"):
+        if line[:3] == "```":
+            code_block = not code_block
+        elif not code_block and re.search(r"^#+\ .*$", line):
+            title, level, _ = format_header(line)
+            if level <= depth:
+                if header or "".join(lines).strip():
+                    sections.append((header, "\n".join(lines)))
+                header = title.strip("* ")
+                lines = []
+        lines.append(line)
+    sections.append((header, "\n".join(lines)))
+    return sections
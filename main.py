@@ -1,17 +1,23 @@
+import asyncio
 import os
 from hashlib import md5
 from pathlib import Path
-from typing import Dict, Tuple
+from typing import Dict, List, Optional, Tuple
 
 import pandas as pd
 from dotenv import load_dotenv
 
 from doc import loadingBar
-from doc.agentic import agenticImprove, convertToBRD, getDiffPoints
+from doc.agentic import (
+    agenticImproveAsync,
+    convertToBRDAsync,
+    convertToBRDChunkedAsync,
+    getDiffPoints,
+)
 from doc.debugPrint import Log, genDebugFunction
 from doc.model import DocuLink
 from doc.network import checkDownloadable, downloadFile
-from doc.processing import DLinkFromNumpy, convertToMarkdown
+from doc.processing import DLinkFromNumpy, convertToMarkdownPaged
 from doc.rag import DocuRAG
 from utils import createDataStorage
 
@@ -21,16 +27,23 @@ printf = genDebugFunction()
 
 
 class DocuFlow(object):
-    def __init__(self, documentCSV: Path, codeBase: Path):
+    def __init__(self, documentCSV: Path, codeBase: Path, chunkedBRD=False):
         printf("  Initializing DocuMan  ".center(50, "v"), Log.WRN)
+        # Write new BRDs section by section, for guides too large for one
+        # prompt. Whatever this is set to, a BRD is updated section by
+        # section when its guide changes, so that only the sections whose
+        # CG text changed are generated and critiqued again.
+        self.chunkedBRD = chunkedBRD
         createDataStorage()
         self.docList = pd.read_csv(documentCSV)
         self.docs: Dict[str, DocuLink] = {}
 
-        for doc in self.docList.to_numpy():
-            doc = DLinkFromNumpy(doc)
-            self.processDocLink(doc, True)
-            print()
+        asyncio.run(
+            self.processDocLinksAsync(
+                [DLinkFromNumpy(doc) for doc in self.docList.to_numpy()], True
+            )
+        )
+        print()
 
         printf("Adding Code to RAG DB".center(50, "-"), Log.WRN)
         self.ragAgent = DocuRAG(savePath=Path("./data/ragData"), dbName="differ")
@@ -41,88 +54,90 @@ class DocuFlow(object):
         print()
 
     def processDocLink(self, newDoc: DocuLink, download=False) -> Tuple[bool, str, str]:
-        print()
-        printf(f"  Processing {newDoc.guideName} Guide  ".center(50, "*"), Log.WRN)
-        proc = loadingBar.LoadingAnim(loadingMessage="Processing", doneMessage="")
-        proc.start()
+        """Blocking processDocLinkAsync"""
+        return asyncio.run(self.processDocLinkAsync(newDoc, download))
+
+    def useChunkedBRD(self, previousBRD: Optional[Path]) -> bool:
+        """Whether to write the BRD by sections, reusing the unchanged ones of previousBRD"""
+        return self.chunkedBRD or previousBRD is not None
+
+    async def processDocLinksAsync(self, docs: List[DocuLink], download=False):
+        """Process guides concurrently; the shared LLM client bounds the requests in flight"""
+        return await asyncio.gather(
+            *(self.processDocLinkAsync(doc, download) for doc in docs)
+        )
+
+    async def processDocLinkAsync(
+        self, newDoc: DocuLink, download=False
+    ) -> Tuple[bool, str, str]:
+        """
+        Process a new or updated guide, returning whether its markdown changed and both versions.
+
+        Downloads, hashing and markdown conversion run in threads, and
+        progress is printed per guide instead of with a loading bar.
+        """
+        name = newDoc.guideName
+        printf(f"Processing {name} Guide", Log.WRN)
         oldMD = None
         updated = False
-        if newDoc.guideName in self.docs:
-            proc.stop()
-            printf(f"Updating {newDoc.guideName}", Log.INF)
-            proc.start(loadingMessage="Updating", doneMessage="")
-            oldDoc = self.docs[newDoc.guideName]
-            oldPDFHash = md5(open(oldDoc.pdfPath, "rb").read()).hexdigest()
-            newPDFHash = md5(open(newDoc.pdfPath, "rb").read()).hexdigest()
+        previousBRD = newDoc.brdPath
+        if name in self.docs:
+            printf(f"Updating {name}", Log.INF)
+            oldDoc = self.docs[name]
+            previousBRD = oldDoc.brdPath
+            oldPDFHash, newPDFHash = await asyncio.gather(
+                asyncio.to_thread(getFileHash, oldDoc.pdfPath),
+                asyncio.to_thread(getFileHash, newDoc.pdfPath),
+            )
             if oldPDFHash == newPDFHash:
-                proc.stop()
-                printf("PDF Contents didnt change, skipping update", Log.WRN)
-                printf("*" * 50, Log.WRN)
-                print()
+                printf(f"{name}: PDF Contents didnt change, skipping update", Log.WRN)
                 return (False, "", "")
             newDoc.accountable = oldDoc.accountable
             newDoc.consulted = oldDoc.consulted
             newDoc.informed = oldDoc.informed
             newDoc.responsible = oldDoc.responsible
-            newDoc.link = newDoc.link
             newDoc.improveCounter = 0
             if os.path.exists(str(oldDoc.mdPath)):
                 oldMD = open(str(oldDoc.mdPath)).read()
                 updated = True
         if download:
-            proc.start(loadingMessage="Downloading")
-            isDownloadable = checkDownloadable(newDoc)
+            isDownloadable = await asyncio.to_thread(checkDownloadable, newDoc)
             if isDownloadable:
-                newDoc, updated = downloadFile(newDoc)
+                newDoc, updated = await asyncio.to_thread(downloadFile, newDoc)
             else:
-                proc.stop()
-                printf(f"{newDoc.guideName} not downloadable, skipping.", Log.ERR)
-                printf("*" * 50, Log.ERR)
-                print()
+                printf(f"{name} not downloadable, skipping.", Log.ERR)
                 return (False, "", "")
-        self.docs[newDoc.guideName] = newDoc
+        self.docs[name] = newDoc
 
         if updated or (newDoc.mdPath is None):
-            proc.stop()
-            printf(f"Converting {newDoc.guideName} to Markdown")
-            proc.start(loadingMessage="Converting to MD")
-            newDoc = convertToMarkdown(newDoc)
+            printf(f"Converting {name} to Markdown")
+            newDoc = await asyncio.to_thread(convertToMarkdownPaged, newDoc)
         else:
-            proc.stop()
-            printf("MD Already Exists", Log.WRN)
-            proc.start()
+            printf(f"{name}: MD Already Exists", Log.WRN)
         if updated or (newDoc.brdPath is None):
-            proc.stop()
-            printf(f"Converting {newDoc.guideName} to BRD")
-            # proc.start("Creating BRD using Agents")
-            newDoc = convertToBRD(newDoc, os.getenv("GEMINI_API_KEY"))
-            newDoc = agenticImprove(newDoc, os.getenv("GEMINI_API_KEY"))
+            printf(f"Converting {name} to BRD")
+            if self.useChunkedBRD(previousBRD):
+                newDoc = await convertToBRDChunkedAsync(
+                    newDoc, os.getenv("GEMINI_API_KEY"), previousBRD=previousBRD
+                )
+            else:
+                newDoc = await convertToBRDAsync(newDoc, os.getenv("GEMINI_API_KEY"))
+                newDoc = await agenticImproveAsync(
+                    newDoc, os.getenv("GEMINI_API_KEY")
+                )
         else:
-            proc.stop()
-            printf("BRD Already Exists", Log.WRN)
-            proc.start()
+            printf(f"{name}: BRD Already Exists", Log.WRN)
 
-        self.docs[newDoc.guideName] = newDoc
+        self.docs[name] = newDoc
         if oldMD:
             newMD = open(str(newDoc.mdPath)).read()
             if md5(oldMD.encode()).hexdigest() != md5(newMD.encode()).hexdigest():
-                proc.stop()
-                printf(
-                    "  Done Processing, Update Available  ".center(50, "*") + "\n",
-                    Log.SUC,
-                )
+                printf(f"{name}: Done Processing, Update Available", Log.SUC)
                 return (True, oldMD, newMD)
-            else:
-                proc.stop()
-                printf(
-                    "  Done Processing, Doc Didn't Change  ".center(50, "*") + "\n",
-                    Log.SUC,
-                )
-                return (False, "", "")
-        else:
-            proc.stop()
-            printf("  Done Processing, Saved New Doc  ".center(50, "*") + "\n", Log.SUC)
+            printf(f"{name}: Done Processing, Doc Didn't Change", Log.SUC)
             return (False, "", "")
+        printf(f"{name}: Done Processing, Saved New Doc", Log.SUC)
+        return (False, "", "")
 
     def loop(self):
         try:
@@ -224,6 +239,15 @@ class DocuFlow(object):
             return 0
 
 
+def getFileHash(path: Path) -> str:
+    with open(path, "rb") as f:
+        return md5(f.read()).hexdigest()
+
+
 if __name__ == "__main__":
-    flow = DocuFlow(codeBase=Path("codeBase"), documentCSV=Path("docList.csv"))
+    flow = DocuFlow(
+        codeBase=Path("codeBase"),
+        documentCSV=Path("docList.csv"),
+        chunkedBRD=os.getenv("DOCUMAN_CHUNKED_BRD", "").lower() in ("1", "true", "yes"),
+    )
     flow.loop()